@@ -9,22 +9,31 @@ import json
 import random
 import uuid
 import time
-import threading
+import socket
+import heapq
+import itertools
+import struct
+import hashlib
+import inspect
+import unicodedata
 from datetime import datetime, timezone, timedelta
-from collections import ChainMap
+from collections import ChainMap, OrderedDict, deque
+from contextlib import aclosing
 
 # Yangi import qo'shildi
 from telegram.error import BadRequest, TelegramError
 
 import asyncpg
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton,
     InputMediaPhoto, LabeledPrice
 )
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters, ConversationHandler, PreCheckoutQueryHandler
+    ContextTypes, filters, ConversationHandler, PreCheckoutQueryHandler, ChatMemberHandler
 )
 
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -49,6 +58,10 @@ DIGEN_KEYS = json.loads(os.getenv("DIGEN_KEYS", "[]"))
 DIGEN_URL = os.getenv("DIGEN_URL", "https://api.digen.ai/v2/tools/text_to_image")
 DATABASE_URL = os.getenv("DATABASE_URL")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Bir nechta Gemini kaliti: vergul bilan ajratilgan; bo'lmasa GEMINI_API_KEY ishlatiladi
+GEMINI_API_KEYS = [k.strip() for k in os.getenv("GEMINI_API_KEYS", "").split(",") if k.strip()] or (
+    [GEMINI_API_KEY] if GEMINI_API_KEY else []
+)
 
 if not BOT_TOKEN:
     logger.error("BOT_TOKEN muhim! ENV ga qo'ying.")
@@ -59,8 +72,8 @@ if not DATABASE_URL:
 if ADMIN_ID == 0:
     logger.error("ADMIN_ID muhim! ENV ga qo'ying.")
     raise SystemExit(1)
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+if GEMINI_API_KEYS:
+    genai.configure(api_key=GEMINI_API_KEYS[0])
 else:
     logger.warning("GEMINI_API_KEY kiritilmagan. AI chat funksiyasi ishlamaydi.")
 
@@ -1300,6 +1313,11 @@ try:
     )
     LANGUAGES.setdefault("uz", {}).setdefault("quota_reset", "🕛 Kunlik limit har kuni 00:00 (UTC+5) da yangilanadi.")
     LANGUAGES.setdefault("uz", {}).setdefault("quota_pack_thanks", "✅ To'lov qabul qilindi! +{credits} ta qo'shimcha rasm limiti qo'shildi.")
+    LANGUAGES.setdefault("uz", {}).setdefault("queue_full", "⏳ Hozir navbat juda band. Iltimos, birozdan keyin qayta urinib ko'ring.")
+    LANGUAGES.setdefault("uz", {}).setdefault("digen_unavailable", "⚠️ Rasm xizmati hozir vaqtincha ishlamayapti. Iltimos, birozdan keyin qayta urinib ko'ring.")
+    LANGUAGES.setdefault("uz", {}).setdefault("digen_parked", "⏳ Rasm xizmati hozir sekin ishlayapti. So'rovingiz navbatda — xizmat tiklanishi bilan rasm yuboriladi.")
+    LANGUAGES.setdefault("uz", {}).setdefault("digen_park_timeout", "⚠️ Rasm xizmati uzoq vaqt tiklanmadi, so'rovingiz bekor qilindi. Limit qaytarildi — birozdan keyin qayta urinib ko'ring.")
+    LANGUAGES.setdefault("uz", {}).setdefault("prompt_blocked", "🚫 Bu so'rovda taqiqlangan so'zlar bor. Iltimos, promptni o'zgartiring.")
 
     LANGUAGES.setdefault("en", {}).setdefault("generating_content", "✨ Generating...")
     LANGUAGES.setdefault("en", {}).setdefault("quota_reached",
@@ -1311,6 +1329,11 @@ try:
     )
     LANGUAGES.setdefault("en", {}).setdefault("quota_reset", "🕛 Daily limit resets at 00:00 (UTC+5).")
     LANGUAGES.setdefault("en", {}).setdefault("quota_pack_thanks", "✅ Payment received! +{credits} extra images added.")
+    LANGUAGES.setdefault("en", {}).setdefault("queue_full", "⏳ The generation queue is full right now. Please try again in a moment.")
+    LANGUAGES.setdefault("en", {}).setdefault("digen_unavailable", "⚠️ The image service is temporarily unavailable. Please try again a bit later.")
+    LANGUAGES.setdefault("en", {}).setdefault("digen_parked", "⏳ The image service is slow right now. Your request is queued and will be delivered as soon as it recovers.")
+    LANGUAGES.setdefault("en", {}).setdefault("digen_park_timeout", "⚠️ The image service did not recover in time, so your request was cancelled. Your limit has been restored — please try again later.")
+    LANGUAGES.setdefault("en", {}).setdefault("prompt_blocked", "🚫 This prompt contains blocked terms. Please rephrase it.")
 
     LANGUAGES.setdefault("ru", {}).setdefault("generating_content", "✨ Генерирую...")
     LANGUAGES.setdefault("ru", {}).setdefault("quota_reached",
@@ -1322,54 +1345,229 @@ try:
     )
     LANGUAGES.setdefault("ru", {}).setdefault("quota_reset", "🕛 Лимит обновляется каждый день в 00:00 (UTC+5).")
     LANGUAGES.setdefault("ru", {}).setdefault("quota_pack_thanks", "✅ Оплата получена! Добавлено +{credits} изображений.")
+    LANGUAGES.setdefault("ru", {}).setdefault("queue_full", "⏳ Очередь генерации сейчас переполнена. Попробуйте чуть позже.")
+    LANGUAGES.setdefault("ru", {}).setdefault("digen_unavailable", "⚠️ Сервис генерации временно недоступен. Пожалуйста, попробуйте чуть позже.")
+    LANGUAGES.setdefault("ru", {}).setdefault("digen_parked", "⏳ Сервис генерации сейчас работает медленно. Ваш запрос в очереди и будет выполнен, как только сервис восстановится.")
+    LANGUAGES.setdefault("ru", {}).setdefault("digen_park_timeout", "⚠️ Сервис генерации долго не восстанавливался, запрос отменён. Лимит возвращён — попробуйте позже.")
+    LANGUAGES.setdefault("ru", {}).setdefault("prompt_blocked", "🚫 В запросе есть запрещённые слова. Пожалуйста, измените промпт.")
 except Exception as _e:
     logger.warning(f"[QUOTA LANG WARNING] {_e}")
 
 
+# ---------------- Foydalanuvchi profili (kesh) ----------------
+# Handlerlar til, model, ban va kreditni bitta so'rovda oladi; natija LRU/TTL keshda turadi.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+class UserProfile:
+    __slots__ = ("id", "username", "language_code", "image_model_id", "is_banned", "extra_credits", "expires_at")
+
+    def __init__(self, row, ttl):
+        self.id = row["id"]
+        self.username = row["username"]
+        self.language_code = row["language_code"]
+        self.image_model_id = row["image_model_id"]
+        self.is_banned = bool(row["is_banned"])
+        self.extra_credits = int(row["extra_credits"] or 0)
+        self.expires_at = time.monotonic() + ttl
+
+class UserProfileCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max(int(max_size), 1)
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        profile = self._items.get(user_id)
+        if profile is None or profile.expires_at < time.monotonic():
+            if profile is not None:
+                del self._items[user_id]
+            self.misses += 1
+            return None
+        self._items.move_to_end(user_id)
+        self.hits += 1
+        return profile
+
+    def put(self, profile):
+        self._items[profile.id] = profile
+        self._items.move_to_end(profile.id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._items.pop(user_id, None)
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+USER_PROFILES = UserProfileCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+async def get_user_profile(pool, user_id):
+    profile = USER_PROFILES.get(user_id)
+    if profile:
+        return profile
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT id, username, language_code, image_model_id, is_banned, extra_credits FROM users WHERE id = $1",
+            user_id
+        )
+    if not row:
+        return None
+    profile = UserProfile(row, USER_PROFILES.ttl)
+    USER_PROFILES.put(profile)
+    return profile
+
+async def get_user_lang_code(pool, user_id):
+    profile = await get_user_profile(pool, user_id)
+    return (profile.language_code if profile else None) or DEFAULT_LANGUAGE
+
+def invalidate_user_profile(user_id):
+    USER_PROFILES.invalidate(user_id)
+
+# ---------------- Kesh invalidatsiyasi (LISTEN/NOTIFY) ----------------
+# Bir nechta bot jarayoni ishlaganda har biri o'z keshini tozalashi uchun
+# o'zgarishlar Postgres kanali orqali e'lon qilinadi.
+CACHE_NOTIFY_CHANNEL = os.getenv("CACHE_NOTIFY_CHANNEL", "bot_cache_invalidate")
+CACHE_LISTEN_RECONNECT = float(os.getenv("CACHE_LISTEN_RECONNECT", "5"))
+
+async def invalidate_user(db, user_id, broadcast=True):
+    """Mahalliy keshni tozalaydi va boshqa jarayonlarga NOTIFY yuboradi.
+    db — pool yoki ochiq connection (tranzaksiya ichida bo'lsa, NOTIFY commitda ketadi)."""
+    invalidate_user_profile(user_id)
+    if not broadcast:
+        return
+    try:
+        await db.execute("SELECT pg_notify($1, $2)", CACHE_NOTIFY_CHANNEL, f"user:{int(user_id)}")
+    except Exception as e:
+        logger.warning(f"[CACHE NOTIFY] {user_id}: {e}")
+
+class CacheInvalidationListener:
+    """Alohida asyncpg ulanishida LISTEN qiladi va kelgan xabarlar bo'yicha keshni tozalaydi.
+    Ulanish uzilsa, qayta ulanadi va o'tkazib yuborilgan xabarlar uchun butun keshni tashlaydi."""
+
+    def __init__(self, dsn, channel):
+        self.dsn = dsn
+        self.channel = channel
+        self.received = 0
+        self.reconnects = 0
+        self.connected = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self.received += 1
+        kind, _, value = (payload or "").partition(":")
+        if kind == "user" and value.isdigit():
+            invalidate_user_profile(int(value))
+        elif kind == "all":
+            USER_PROFILES.clear()
+        else:
+            logger.warning(f"[CACHE LISTEN] Noma'lum xabar: {payload!r}")
+
+    async def _run(self):
+        first = True
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda c: lost.set())
+                await conn.add_listener(self.channel, self._on_notify)
+                self.connected = True
+                if not first:
+                    # Uzilish paytida kelgan xabarlar yo'qolgan bo'lishi mumkin
+                    self.reconnects += 1
+                    USER_PROFILES.clear()
+                    logger.info("[CACHE LISTEN] Qayta ulandi, kesh tozalandi")
+                first = False
+                await lost.wait()
+                logger.warning("[CACHE LISTEN] Ulanish uzildi")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[CACHE LISTEN] Ulanish xatosi: {e}")
+            finally:
+                self.connected = False
+                if conn is not None and not conn.is_closed():
+                    try:
+                        await asyncio.shield(conn.close(timeout=5))
+                    except Exception:
+                        pass
+            await asyncio.sleep(CACHE_LISTEN_RECONNECT)
+
 # ---------------- Daily quota ----------------
 DAILY_FREE_IMAGES = int(os.getenv("DAILY_FREE_IMAGES", "50"))
 EXTRA_PACK_SIZE = int(os.getenv("EXTRA_PACK_SIZE", "50"))
 # 50 ta rasm = 50 Stars (1 rasm = 1 Star)
 EXTRA_PACK_PRICE_STARS = int(os.getenv("EXTRA_PACK_PRICE_STARS", "50"))
 
-def tashkent_day_start_utc(now=None):
-    now = now or utc_now()
-    local = now + timedelta(hours=5)
-    local_start = local.replace(hour=0, minute=0, second=0, microsecond=0)
-    return local_start - timedelta(hours=5)
+def tashkent_today(now=None):
+    return ((now or utc_now()) + timedelta(hours=5)).date()
 
 async def get_user_daily_images(pool, user_id):
-    start_utc = tashkent_day_start_utc()
     async with pool.acquire() as conn:
         return int(await conn.fetchval(
-            "SELECT COALESCE(SUM(image_count), 0) FROM generations WHERE user_id=$1 AND created_at >= $2",
-            user_id, start_utc
+            "SELECT images FROM user_daily_usage WHERE user_id=$1 AND tashkent_day=$2",
+            user_id, tashkent_today()
         ) or 0)
 
 async def get_user_extra_credits(pool, user_id):
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT extra_credits FROM users WHERE id=$1", user_id)
-        return int(row["extra_credits"] or 0) if row else 0
+    profile = await get_user_profile(pool, user_id)
+    return int(profile.extra_credits or 0) if profile else 0
 
 async def reserve_quota_or_explain(pool, user_id, requested):
-    """Agar kerak bo'lsa extra_credits dan yechadi. Yetmasa: False + info qaytaradi."""
-    start_utc = tashkent_day_start_utc()
+    """Kunlik limitni band qiladi, kerak bo'lsa extra_credits dan yechadi. Yetmasa: False + info qaytaradi.
+    Hammasi reserve_images() ichida bitta statement bilan bajariladi."""
+    day = tashkent_today()
     async with pool.acquire() as conn:
-        u = await conn.fetchrow("SELECT is_banned, extra_credits FROM users WHERE id=$1", user_id)
-        if u and u["is_banned"]:
-            return False, {"reason": "banned"}
-        used = int(await conn.fetchval(
-            "SELECT COALESCE(SUM(image_count), 0) FROM generations WHERE user_id=$1 AND created_at >= $2",
-            user_id, start_utc
-        ) or 0)
-        credits = int((u["extra_credits"] if u else 0) or 0)
-        need_paid = max(used + requested - DAILY_FREE_IMAGES, 0)
-        if need_paid <= 0:
-            return True, {"used": used, "credits": credits, "need_paid": 0}
-        if credits >= need_paid:
-            await conn.execute("UPDATE users SET extra_credits = extra_credits - $1 WHERE id = $2", need_paid, user_id)
-            return True, {"used": used, "credits": credits - need_paid, "need_paid": need_paid}
-        return False, {"reason": "quota", "used": used, "credits": credits, "need_paid": need_paid}
+        async with conn.transaction():
+            r = await conn.fetchrow(
+                "SELECT * FROM reserve_images($1, $2, $3, $4)",
+                user_id, day, int(requested), DAILY_FREE_IMAGES
+            )
+            if r["ok"] and r["need_paid"]:
+                await invalidate_user(conn, user_id)
+    if r["reason"] == "banned":
+        return False, {"reason": "banned"}
+    info = {"used": r["used"], "credits": r["credits"], "need_paid": r["need_paid"], "day": day}
+    if not r["ok"]:
+        info["reason"] = r["reason"]
+        return False, info
+    return True, info
+
+async def release_quota(pool, user_id, day, images, credits):
+    """Generatsiya bajarilmasa, band qilingan kunlik limit va yechilgan extra_credits ni qaytaradi."""
+    credits = int(credits or 0)
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                if day and images:
+                    await conn.execute(
+                        "UPDATE user_daily_usage SET images = GREATEST(images - $3, 0) "
+                        "WHERE user_id=$1 AND tashkent_day=$2",
+                        user_id, day, int(images)
+                    )
+                if credits > 0:
+                    await conn.execute(
+                        "UPDATE users SET extra_credits = COALESCE(extra_credits, 0) + $1 WHERE id = $2",
+                        credits, user_id
+                    )
+                    await invalidate_user(conn, user_id)
+    except Exception as e:
+        logger.warning(f"[QUOTA RELEASE FAILED] {e}")
 
 DIGEN_MODELS = [
     {
@@ -1525,7 +1723,10 @@ async def admin_user_search_handler(update: Update, context: ContextTypes.DEFAUL
         if user_id is not None:
             user = await conn.fetchrow("SELECT id FROM users WHERE id = $1", user_id)
         elif username:
-            user = await conn.fetchrow("SELECT id FROM users WHERE username = $1", username)
+            user = await conn.fetchrow(
+                "SELECT id FROM users WHERE lower(username) = lower($1) ORDER BY last_seen DESC NULLS LAST LIMIT 1",
+                username
+            )
         else:
             user = None
 
@@ -1547,11 +1748,7 @@ async def random_anime_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         user_id = update.effective_user.id
 
     # Tilni olish
-    lang_code = DEFAULT_LANGUAGE
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", user_id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], user_id)
     lang = get_lang(lang_code)
 
     # Progress xabar
@@ -1563,21 +1760,21 @@ async def random_anime_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         seeds = [random.randint(1, 100000) for _ in range(10)]
         base_url = "https://www.thiswaifudoesnotexist.net/example-{}.jpg"
 
-        async with aiohttp.ClientSession() as session:
-            for seed in seeds:
-                url = base_url.format(seed)
-                try:
-                    async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-                        if resp.status == 200:
-                            image_data = await resp.read()
-                            temp_path = f"/tmp/anime_{uuid.uuid4().hex}.jpg"
-                            with open(temp_path, "wb") as f:
-                                f.write(image_data)
-                            temp_files.append(temp_path)
-                            image_urls.append(url)
-                except Exception as e:
-                    logger.warning(f"[ANIME] Rasm yuklanmadi (seed={seed}): {e}")
-                    continue
+        session = http_session(context.application, "media")
+        for seed in seeds:
+            url = base_url.format(seed)
+            try:
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                    if resp.status == 200:
+                        image_data = await resp.read()
+                        temp_path = f"/tmp/anime_{uuid.uuid4().hex}.jpg"
+                        with open(temp_path, "wb") as f:
+                            f.write(image_data)
+                        temp_files.append(temp_path)
+                        image_urls.append(url)
+            except Exception as e:
+                logger.warning(f"[ANIME] Rasm yuklanmadi (seed={seed}): {e}")
+                continue
 
         if not image_urls:
             await progress_msg.edit_text("⚠️ Hech qanday rasm topilmadi. Qayta urinib ko'ring.")
@@ -1636,24 +1833,19 @@ async def fake_lab_new_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     await q.answer()
 
     user_id = q.from_user.id
-    lang_code = DEFAULT_LANGUAGE
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", user_id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], user_id)
     lang = get_lang(lang_code)
 
     await q.message.reply_text(lang["fake_lab_generating"], parse_mode="Markdown")
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://thispersondoesnotexist.com/",
-                headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-            ) as resp:
-                if resp.status != 200:
-                    raise Exception(f"Status {resp.status}")
-                image_data = await resp.read()
+        async with http_session(context.application, "media").get(
+            "https://thispersondoesnotexist.com/",
+            headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+        ) as resp:
+            if resp.status != 200:
+                raise Exception(f"Status {resp.status}")
+            image_data = await resp.read()
 
         temp_path = f"/tmp/fake_lab_{uuid.uuid4().hex}.jpg"
         with open(temp_path, "wb") as f:
@@ -1699,14 +1891,13 @@ async def fake_lab_refresh_handler(update: Update, context: ContextTypes.DEFAULT
     await q.edit_message_caption(caption=lang["fake_lab_refreshing"], parse_mode="Markdown")
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://thispersondoesnotexist.com/",
-                headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-            ) as resp:
-                if resp.status != 200:
-                    raise Exception(f"Status {resp.status}")
-                image_data = await resp.read()
+        async with http_session(context.application, "media").get(
+            "https://thispersondoesnotexist.com/",
+            headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+        ) as resp:
+            if resp.status != 200:
+                raise Exception(f"Status {resp.status}")
+            image_data = await resp.read()
 
         temp_path = f"/tmp/fake_lab_{uuid.uuid4().hex}.jpg"
         with open(temp_path, "wb") as f:
@@ -1755,6 +1946,92 @@ def utc_now():
 def tashkent_time():
     return datetime.now(timezone.utc) + timedelta(hours=5)
 
+def _mask_token(token):
+    token = token or ""
+    return f"…{token[-6:]}" if len(token) > 6 else token
+
+# ---------------- Umumiy HTTP sessiyalar ----------------
+# Har bir upstream uchun bitta uzoq yashovchi sessiya: keep-alive, DNS kesh va host bo'yicha limit.
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", "100"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "32"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+
+# upstream nomi -> umumiy (total) timeout, soniyada
+HTTP_UPSTREAMS = {
+    "digen": float(os.getenv("DIGEN_SUBMIT_TIMEOUT", "500")),
+    "s3": float(os.getenv("S3_CHECK_TIMEOUT", "50")),
+    "media": float(os.getenv("MEDIA_FETCH_TIMEOUT", "30")),
+}
+
+HTTP_STATS = {
+    name: {"requests": 0, "new_connections": 0, "reused_connections": 0, "dns_hits": 0, "dns_misses": 0}
+    for name in HTTP_UPSTREAMS
+}
+
+def _http_trace_config(stats):
+    trace = aiohttp.TraceConfig()
+
+    async def _on_request_start(session, ctx, params):
+        stats["requests"] += 1
+
+    async def _on_connection_create_end(session, ctx, params):
+        stats["new_connections"] += 1
+
+    async def _on_connection_reuseconn(session, ctx, params):
+        stats["reused_connections"] += 1
+
+    async def _on_dns_cache_hit(session, ctx, params):
+        stats["dns_hits"] += 1
+
+    async def _on_dns_cache_miss(session, ctx, params):
+        stats["dns_misses"] += 1
+
+    trace.on_request_start.append(_on_request_start)
+    trace.on_connection_create_end.append(_on_connection_create_end)
+    trace.on_connection_reuseconn.append(_on_connection_reuseconn)
+    trace.on_dns_cache_hit.append(_on_dns_cache_hit)
+    trace.on_dns_cache_miss.append(_on_dns_cache_miss)
+    return trace
+
+def create_http_sessions():
+    sessions = {}
+    for name, total in HTTP_UPSTREAMS.items():
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        )
+        sessions[name] = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=total, connect=HTTP_CONNECT_TIMEOUT),
+            trace_configs=[_http_trace_config(HTTP_STATS[name])],
+        )
+    return sessions
+
+async def close_http_sessions(sessions):
+    for name, session in sessions.items():
+        try:
+            await session.close()
+        except Exception as e:
+            logger.warning(f"[HTTP] {name} sessiyasini yopib bo'lmadi: {e}")
+
+def http_session(app, name):
+    return app.bot_data["http"][name]
+
+def http_stats_lines():
+    lines = []
+    for name, s in HTTP_STATS.items():
+        conns = s["new_connections"] + s["reused_connections"]
+        reuse = (s["reused_connections"] / conns * 100) if conns else 0.0
+        lines.append(
+            f"• {name}: {s['requests']} so'rov, {s['new_connections']} yangi / "
+            f"{s['reused_connections']} qayta ulanish ({reuse:.0f}%)"
+        )
+    return lines
+
 # ---------------- DB schema ----------------
 CREATE_TABLES_SQL = """
 CREATE TABLE IF NOT EXISTS meta (
@@ -1770,8 +2047,18 @@ CREATE TABLE IF NOT EXISTS users (
     is_banned BOOLEAN DEFAULT FALSE,
     language_code TEXT DEFAULT 'uz',
     image_model_id TEXT DEFAULT '',
-    extra_credits INT DEFAULT 0
+    extra_credits INT DEFAULT 0,
+    total_images BIGINT DEFAULT 0
+);
+
+-- Kunlik limit uchun hisoblagich: generations bo'yicha SUM o'rniga bitta qator
+CREATE TABLE IF NOT EXISTS user_daily_usage (
+    user_id BIGINT NOT NULL,
+    tashkent_day DATE NOT NULL,
+    images INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, tashkent_day)
 );
+CREATE INDEX IF NOT EXISTS user_daily_usage_day_idx ON user_daily_usage(tashkent_day);
 
 CREATE TABLE IF NOT EXISTS sessions (
     id SERIAL PRIMARY KEY,
@@ -1779,6 +2066,25 @@ CREATE TABLE IF NOT EXISTS sessions (
     started_at TIMESTAMPTZ
 );
 
+-- Gemini prompt tarjimalari keshi (normallashtirilgan prompt sha256 bo'yicha)
+CREATE TABLE IF NOT EXISTS prompt_translations (
+    prompt_hash TEXT PRIMARY KEY,
+    prompt TEXT,
+    translated TEXT,
+    refused BOOLEAN NOT NULL DEFAULT FALSE,
+    hits INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT now(),
+    last_hit_at TIMESTAMPTZ
+);
+
+-- Kunlik faollik: har kun uchun user_id >> 16 bo'laklari bo'yicha bitmaplar (ActivityBitmap)
+CREATE TABLE IF NOT EXISTS daily_activity (
+    tashkent_day DATE NOT NULL,
+    chunk BIGINT NOT NULL,
+    bits BYTEA NOT NULL,
+    PRIMARY KEY (tashkent_day, chunk)
+);
+
 CREATE TABLE IF NOT EXISTS generations (
     id SERIAL PRIMARY KEY,
     user_id BIGINT,
@@ -1800,6 +2106,75 @@ CREATE TABLE IF NOT EXISTS donations (
     refunded_at TIMESTAMPTZ,
     created_at TIMESTAMPTZ DEFAULT now()
 );
+
+CREATE TABLE IF NOT EXISTS generation_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    username TEXT,
+    chat_id BIGINT NOT NULL,
+    lang_code TEXT,
+    prompt TEXT,
+    translated_prompt TEXT,
+    final_prompt TEXT,
+    lora_id TEXT,
+    image_count INT NOT NULL,
+    paid_credits INT DEFAULT 0,
+    reserved_day DATE,
+    state TEXT NOT NULL DEFAULT 'queued',
+    image_id TEXT,
+    digen_key TEXT,
+    error TEXT,
+    worker_id TEXT,
+    attempts INT DEFAULT 0,
+    heartbeat_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT now(),
+    submitted_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS generation_jobs_active_idx
+    ON generation_jobs(id) WHERE state IN ('queued', 'submitted', 'polling', 'delivering');
+"""
+
+# Limitni bitta chaqiruvda band qiladi: foydalanuvchi va kunlik qator bloklanadi,
+# bepul limitdan qolgani ishlatiladi, yetmagani extra_credits dan yechiladi.
+RESERVE_IMAGES_SQL = """
+CREATE OR REPLACE FUNCTION reserve_images(p_user BIGINT, p_day DATE, p_count INT, p_free INT)
+RETURNS TABLE(ok BOOLEAN, reason TEXT, used INT, credits INT, need_paid INT)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_banned BOOLEAN;
+    v_credits INT;
+    v_used INT;
+    v_paid INT;
+BEGIN
+    SELECT COALESCE(u.is_banned, FALSE), COALESCE(u.extra_credits, 0)
+      INTO v_banned, v_credits
+      FROM users u WHERE u.id = p_user FOR UPDATE;
+    IF v_banned THEN
+        RETURN QUERY SELECT FALSE, 'banned'::TEXT, 0, 0, 0;
+        RETURN;
+    END IF;
+    v_credits := COALESCE(v_credits, 0);
+
+    INSERT INTO user_daily_usage AS d (user_id, tashkent_day, images)
+    VALUES (p_user, p_day, 0)
+    ON CONFLICT (user_id, tashkent_day) DO UPDATE SET images = d.images
+    RETURNING d.images INTO v_used;
+
+    v_paid := GREATEST(p_count - GREATEST(p_free - v_used, 0), 0);
+    IF v_paid > v_credits THEN
+        RETURN QUERY SELECT FALSE, 'quota'::TEXT, v_used, v_credits, v_paid;
+        RETURN;
+    END IF;
+
+    UPDATE user_daily_usage SET images = images + p_count
+     WHERE user_id = p_user AND tashkent_day = p_day;
+    IF v_paid > 0 THEN
+        UPDATE users SET extra_credits = extra_credits - v_paid WHERE id = p_user;
+    END IF;
+    RETURN QUERY SELECT TRUE, NULL::TEXT, v_used, v_credits - v_paid, v_paid;
+END;
+$$;
 """
 
 async def init_db(pool):
@@ -1838,54 +2213,433 @@ async def init_db(pool):
             logger.info("✅ Added columns 'charge_id', 'refunded_at' to table 'donations'")
         except Exception as e:
             logger.info(f"ℹ️ Columns already exist or error: {e}")
+        try:
+            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS total_images BIGINT DEFAULT 0")
+            await conn.execute("ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS reserved_day DATE")
+        except Exception as e:
+            logger.info(f"ℹ️ Columns already exist or error: {e}")
+        try:
+            # Kunlik hisoblar user_daily_usage da; generations.tashkent_day (va indeksi) kerak emas.
+            # DROP COLUMN jadvalni qayta yozmaydi — faqat katalog yangilanadi.
+            # ALTER har doim ACCESS EXCLUSIVE qulf oladi, shuning uchun faqat ustun bor bo'lsa bajariladi.
+            has_column = await conn.fetchval(
+                "SELECT 1 FROM information_schema.columns "
+                "WHERE table_name = 'generations' AND column_name = 'tashkent_day'"
+            )
+            if has_column:
+                await conn.execute("ALTER TABLE generations DROP COLUMN tashkent_day")
+        except Exception as e:
+            logger.info(f"ℹ️ Column 'tashkent_day' drop error: {e}")
 
-# ---------------- Digen headers ----------------
-import threading
+        await conn.execute(RESERVE_IMAGES_SQL)
+        await backfill_usage_counters(conn)
+        await migrate_sessions_to_activity(conn)
 
-# Global indeks va lock
-_digen_key_index = 0
-_digen_lock = threading.Lock()
+async def backfill_usage_counters(conn):
+    """Eski generations tarixidan kunlik va umumiy hisoblagichlarni bir marta to'ldiradi."""
+    async with conn.transaction():
+        done = await conn.fetchval("SELECT value FROM meta WHERE key = 'usage_backfilled' FOR UPDATE")
+        if done:
+            return
+        await conn.execute(
+            "INSERT INTO user_daily_usage(user_id, tashkent_day, images) "
+            "SELECT user_id, (created_at AT TIME ZONE 'Asia/Tashkent')::date, SUM(image_count) "
+            "FROM generations WHERE user_id IS NOT NULL AND created_at IS NOT NULL "
+            "GROUP BY 1, 2 "
+            "ON CONFLICT (user_id, tashkent_day) DO UPDATE SET images = EXCLUDED.images"
+        )
+        await conn.execute(
+            "UPDATE users u SET total_images = g.total FROM ("
+            "  SELECT user_id, SUM(image_count) AS total FROM generations GROUP BY user_id"
+            ") g WHERE g.user_id = u.id"
+        )
+        await conn.execute(
+            "INSERT INTO meta(key, value) VALUES('usage_backfilled', $1) "
+            "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+            str(int(time.time()))
+        )
+        logger.info("✅ user_daily_usage va users.total_images to'ldirildi")
+
+# ---------------- Indekslar ----------------
+# main.py dagi so'rovlardan kelib chiqqan indekslar. CONCURRENTLY bilan quriladi,
+# shuning uchun har biri alohida statement va tranzaksiyadan tashqarida bajariladi.
+DB_INDEXES = [
+    # Foydalanuvchi tarixi, gen_count va oxirgi 10 ta generatsiya (index-only scan)
+    ("generations_user_created_idx",
+     "generations(user_id, created_at DESC) INCLUDE (image_count)"),
+    # Vaqt oralig'i bo'yicha statistikalar (7 kunlik faol va h.k.) — kichik BRIN
+    ("generations_created_brin",
+     "generations USING brin(created_at)"),
+    ("donations_charge_id_idx",
+     "donations(charge_id) WHERE charge_id IS NOT NULL"),
+    ("donations_user_id_idx",
+     "donations(user_id)"),
+    # Refund ro'yxati: qaytarilmagan to'lovlarning oxirgilari
+    ("donations_refundable_idx",
+     "donations(created_at DESC) WHERE refunded_at IS NULL AND charge_id IS NOT NULL"),
+    ("users_username_lower_idx",
+     "users(lower(username))"),
+    ("users_last_seen_idx",
+     "users(last_seen DESC)"),
+    ("users_first_seen_idx",
+     "users(first_seen)"),
+]
 
-def get_digen_headers():
-    global _digen_key_index
-    if not DIGEN_KEYS:
-        return {}
-    with _digen_lock:
-        key = DIGEN_KEYS[_digen_key_index % len(DIGEN_KEYS)]
-        _digen_key_index += 1
-    return {
-        "accept": "application/json, text/plain, */*",
-        "content-type": "application/json",
-        "digen-language": "en-US",
-        "digen-platform": "web",
-        "digen-token": key.get("token", ""),
-        "digen-sessionid": key.get("session", ""),
-        "origin": "https://digen.ai",
-        "referer": "https://digen.ai/image",
-    }
+async def ensure_indexes(dsn):
+    """Indekslarni alohida ulanishda yaratadi. Uzilgan CONCURRENTLY qurilishidan qolgan
+    INVALID indeks avval o'chiriladi, aks holda IF NOT EXISTS uni o'tkazib yuboradi."""
+    try:
+        conn = await asyncpg.connect(dsn)
+    except Exception as e:
+        logger.warning(f"[DB INDEX] Ulanib bo'lmadi: {e}")
+        return
+    try:
+        invalid = {
+            r["relname"] for r in await conn.fetch(
+                "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid"
+            )
+        }
+        for name, spec in DB_INDEXES:
+            try:
+                if name in invalid:
+                    logger.warning(f"[DB INDEX] {name} INVALID, qayta quriladi")
+                    await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                started = time.monotonic()
+                await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {spec}")
+                elapsed = time.monotonic() - started
+                if elapsed > 1:
+                    logger.info(f"[DB INDEX] {name} {elapsed:.1f}s da qurildi")
+            except Exception as e:
+                logger.warning(f"[DB INDEX] {name}: {e}")
+    finally:
+        await conn.close()
+
+# ---------------- Digen kalitlar puli ----------------
+# Har bir kalitga bir vaqtda nechta submit ruxsat etiladi
+DIGEN_KEY_MAX_CONCURRENCY = int(os.getenv("DIGEN_KEY_MAX_CONCURRENCY", "2"))
+DIGEN_KEY_ACQUIRE_TIMEOUT = float(os.getenv("DIGEN_KEY_ACQUIRE_TIMEOUT", "120"))
+# Xatolikdan keyin kalit necha soniya dam oladi
+DIGEN_KEY_COOLDOWN_AUTH = float(os.getenv("DIGEN_KEY_COOLDOWN_AUTH", "900"))     # 401/403 — token eskirgan
+DIGEN_KEY_COOLDOWN_RATE = float(os.getenv("DIGEN_KEY_COOLDOWN_RATE", "60"))      # 429
+DIGEN_KEY_COOLDOWN_SERVER = float(os.getenv("DIGEN_KEY_COOLDOWN_SERVER", "15"))  # 5xx / tarmoq xatosi
+# Hedging: kalitning p95 latency'si o'tib ketsa, xuddi shu payload ikkinchi kalit orqali yuboriladi
+DIGEN_HEDGE_ENABLED = os.getenv("DIGEN_HEDGE_ENABLED", "0") == "1"
+DIGEN_HEDGE_MAX_FRACTION = float(os.getenv("DIGEN_HEDGE_MAX_FRACTION", "0.1"))
+DIGEN_HEDGE_MIN_SAMPLES = int(os.getenv("DIGEN_HEDGE_MIN_SAMPLES", "20"))
+
+class DigenKey:
+    def __init__(self, index, cfg):
+        self.index = index
+        self.token = cfg.get("token", "")
+        self.session = cfg.get("session", "")
+        self.label = f"#{index + 1} {_mask_token(self.token)}"
+        self.in_flight = 0
+        self.ok = 0
+        self.fail = 0
+        self.errors = {}
+        self.latency_ewma = None
+        self.latencies = deque(maxlen=200)
+        self.cooldown_until = 0.0
+
+    def p95(self):
+        if len(self.latencies) < DIGEN_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+
+    @property
+    def success_rate(self):
+        total = self.ok + self.fail
+        return self.ok / total if total else 1.0
+
+    def cooling_down(self, now=None):
+        return self.cooldown_until > (now or time.monotonic())
+
+    def headers(self):
+        return {
+            "accept": "application/json, text/plain, */*",
+            "content-type": "application/json",
+            "digen-language": "en-US",
+            "digen-platform": "web",
+            "digen-token": self.token,
+            "digen-sessionid": self.session,
+            "origin": "https://digen.ai/image",
+            "referer": "https://digen.ai/image",
+        }
+
+class DigenKeysUnavailable(Exception):
+    """Kutish vaqtida bo'sh kalit chiqmadi — bu Digen xatosi emas, breaker'ga hisoblanmaydi."""
+
+class DigenKeyPool:
+    """DIGEN_KEYS uchun asyncio pul: har kalitning band joblari, muvaffaqiyat darajasi,
+    xato kodlari va submit latency'si kuzatiladi. Dam olayotgan kalitlar o'tkazib yuboriladi,
+    qolganlari ichidan eng tez sog'lom kalit tanlanadi."""
+
+    def __init__(self, keys, max_concurrency):
+        self.keys = [DigenKey(i, k) for i, k in enumerate(keys or [])]
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self._cond = asyncio.Condition()
+        self.submits = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _score(self, key):
+        # Noma'lum latency = 0, yangi kalitlar ham sinab ko'riladi
+        latency = key.latency_ewma or 0.0
+        return (latency * (1 + key.in_flight)) / max(key.success_rate, 0.05)
+
+    def _pick(self, exclude=()):
+        now = time.monotonic()
+        candidates = [
+            k for k in self.keys
+            if k not in exclude and not k.cooling_down(now) and k.in_flight < self.max_concurrency
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=self._score)
+
+    def _next_cooldown_end(self):
+        now = time.monotonic()
+        ends = [k.cooldown_until - now for k in self.keys if k.cooling_down(now)]
+        return min(ends) if ends else None
+
+    async def acquire(self, timeout=DIGEN_KEY_ACQUIRE_TIMEOUT, exclude=()):
+        if not self.keys:
+            raise RuntimeError("DIGEN_KEYS bo'sh — Digen kaliti yo'q")
+        deadline = time.monotonic() + timeout
+        async with self._cond:
+            while True:
+                key = self._pick(exclude)
+                if key:
+                    key.in_flight += 1
+                    return key
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DigenKeysUnavailable("Bo'sh Digen kaliti topilmadi")
+                # Dam olish tugashi yoki release() bo'lishini kutamiz
+                wait = remaining
+                cooldown_end = self._next_cooldown_end()
+                if cooldown_end is not None:
+                    wait = min(wait, max(cooldown_end, 0.05))
+                try:
+                    await asyncio.wait_for(self._cond.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    def try_acquire(self, exclude=()):
+        """Kutmasdan bo'sh kalit oladi (hedge uchun). Bo'lmasa None."""
+        key = self._pick(exclude)
+        if key:
+            key.in_flight += 1
+        return key
+
+    def hedge_allowed(self):
+        return self.hedges < self.submits * DIGEN_HEDGE_MAX_FRACTION
+
+    async def release(self, key, status=None, latency=None, ok=False, abandoned=False):
+        key.in_flight = max(key.in_flight - 1, 0)
+        if abandoned:
+            # Hedge yutqazgan so'rov — kalit aybdor emas, statistikaga yozilmaydi
+            pass
+        elif ok:
+            key.ok += 1
+            if latency is not None:
+                key.latency_ewma = latency if key.latency_ewma is None else 0.8 * key.latency_ewma + 0.2 * latency
+                key.latencies.append(latency)
+        else:
+            key.fail += 1
+            code = str(status) if status is not None else "network"
+            key.errors[code] = key.errors.get(code, 0) + 1
+            cooldown = 0
+            if status in (401, 403):
+                cooldown = DIGEN_KEY_COOLDOWN_AUTH
+            elif status == 429:
+                cooldown = DIGEN_KEY_COOLDOWN_RATE
+            elif status is None or status >= 500:
+                cooldown = DIGEN_KEY_COOLDOWN_SERVER
+            if cooldown:
+                key.cooldown_until = time.monotonic() + cooldown
+                logger.warning(f"[DIGEN KEY] {key.label} {code} sababli {int(cooldown)}s dam oladi")
+        async with self._cond:
+            self._cond.notify_all()
+
+    def capacity(self):
+        return len(self.keys) * self.max_concurrency
+
+    def stats_lines(self):
+        now = time.monotonic()
+        lines = []
+        if DIGEN_HEDGE_ENABLED:
+            lines.append(f"🪁 Hedge: {self.hedges}/{self.submits} submit, {self.hedge_wins} tasi yutdi")
+        for k in self.keys:
+            state = f"⏸ {int(k.cooldown_until - now)}s" if k.cooling_down(now) else "✅"
+            latency = f"{k.latency_ewma:.1f}s" if k.latency_ewma is not None else "—"
+            errors = ", ".join(f"{c}×{n}" for c, n in sorted(k.errors.items())) or "—"
+            lines.append(
+                f"{state} `{k.label}` | band {k.in_flight}/{self.max_concurrency} | "
+                f"ok {k.ok} / xato {k.fail} ({k.success_rate * 100:.0f}%) | {latency} | {errors}"
+            )
+        return lines
+
+class DigenSubmitError(Exception):
+    def __init__(self, message, status=None, key=None):
+        super().__init__(message)
+        self.status = status
+        self.key = key
+
+async def _digen_submit_with_key(app, key, payload):
+    key_pool = app.bot_data["digen_keys"]
+    started = time.monotonic()
+    status = None
+    ok = False
+    abandoned = False
+    try:
+        async with http_session(app, "digen").post(DIGEN_URL, headers=key.headers(), json=payload) as resp:
+            status = resp.status
+            if resp.status != 200:
+                body = await resp.text()
+                raise DigenSubmitError(f"Digen status {resp.status}: {body[:300]}", status=resp.status, key=key)
+            data = await resp.json()
+        image_id = (data.get("data") or {}).get("id") or data.get("id")
+        if not image_id:
+            raise DigenSubmitError(f"Digen javobida image_id yo'q: {data}", status=status, key=key)
+        ok = True
+        return str(image_id).strip(), key
+    except asyncio.CancelledError:
+        abandoned = True
+        raise
+    finally:
+        await key_pool.release(key, status=status, latency=time.monotonic() - started, ok=ok, abandoned=abandoned)
+
+async def digen_submit(app, payload):
+    """Payloadni pul tanlagan kalit orqali Digen ga yuboradi. (image_id, key) qaytaradi.
+
+    DIGEN_HEDGE_ENABLED bo'lsa va javob kalitning p95 latency'sidan kechiksa, xuddi shu
+    payload boshqa sog'lom kalit orqali ham yuboriladi; birinchi image_id qaytargani olinadi,
+    ikkinchisi bekor qilinadi. Hedge'lar umumiy submitlarning DIGEN_HEDGE_MAX_FRACTION qismi bilan cheklanadi.
+    """
+    key_pool = app.bot_data["digen_keys"]
+    key = await key_pool.acquire()
+    key_pool.submits += 1
+    primary = asyncio.create_task(_digen_submit_with_key(app, key, payload))
+    tasks = {primary}
+    try:
+        hedge_after = key.p95() if DIGEN_HEDGE_ENABLED else None
+        if hedge_after is None:
+            return await primary
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if done:
+            return primary.result()
+        hedge_key = key_pool.try_acquire(exclude=(key,)) if key_pool.hedge_allowed() else None
+        if not hedge_key:
+            return await primary
+        key_pool.hedges += 1
+        logger.info(f"[DIGEN HEDGE] {key.label} {hedge_after:.1f}s dan oshdi, {hedge_key.label} orqali qayta yuborildi")
+        hedge = asyncio.create_task(_digen_submit_with_key(app, hedge_key, payload))
+        tasks.add(hedge)
+        pending = set(tasks)
+        last_error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    if t is hedge:
+                        key_pool.hedge_wins += 1
+                    return t.result()
+                last_error = t.exception()
+        raise last_error
+    finally:
+        # Yutqazgan (yoki tashqaridan bekor qilingan) so'rovlarni to'xtatamiz
+        leftovers = [t for t in tasks if not t.done()]
+        for t in leftovers:
+            t.cancel()
+        if leftovers:
+            await asyncio.gather(*leftovers, return_exceptions=True)
 
 
 #--------------------------
 async def check_ban(user_id: int, pool) -> bool:
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT is_banned FROM users WHERE id = $1", user_id)
-        if row and row["is_banned"]:
-            return True
-    return False
+    profile = await get_user_profile(pool, user_id)
+    return bool(profile and profile.is_banned)
 # ---------------- subscription check ----------------
-async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+# A'zolik natijalari keshda: ijobiy uzoqroq, salbiy qisqa (foydalanuvchi hozir obuna bo'lishi mumkin).
+# Kanaldagi chat_member yangilanishlari keshni darhol yangilaydi, shuning uchun chiqib ketish ham ushlanadi.
+SUB_CACHE_POSITIVE_TTL = float(os.getenv("SUB_CACHE_POSITIVE_TTL", "600"))
+SUB_CACHE_NEGATIVE_TTL = float(os.getenv("SUB_CACHE_NEGATIVE_TTL", "20"))
+SUB_CACHE_SIZE = int(os.getenv("SUB_CACHE_SIZE", "100000"))
+SUB_MEMBER_STATUSES = ("member", "administrator", "creator")
+
+class SubscriptionCache:
+    def __init__(self, max_size):
+        self.max_size = max(int(max_size), 1)
+        # (channel_id, user_id) -> (a'zomi, tugash vaqti)
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self.updates = 0
+
+    def get(self, channel_id, user_id):
+        key = (channel_id, user_id)
+        item = self._items.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self._items[key]
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, channel_id, user_id, is_member):
+        ttl = SUB_CACHE_POSITIVE_TTL if is_member else SUB_CACHE_NEGATIVE_TTL
+        key = (channel_id, user_id)
+        self._items[key] = (is_member, time.monotonic() + ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+SUB_CACHE = SubscriptionCache(SUB_CACHE_SIZE)
+
+async def _fetch_membership(bot, channel, user_id):
+    SUB_CACHE.api_calls += 1
+    try:
+        member = await bot.get_chat_member(channel["id"], user_id)
+        is_member = member.status in SUB_MEMBER_STATUSES
+    except Exception as e:
+        logger.debug(f"[SUB CHECK ERROR] Kanal {channel['id']}: {e}")
+        is_member = False
+    SUB_CACHE.put(channel["id"], user_id, is_member)
+    return is_member
+
+async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE, force: bool = False) -> bool:
     """
     Foydalanuvchi barcha majburiy kanallarga obuna bo'lganligini tekshiradi.
+    Keshda yo'q kanallar parallel so'raladi; force=True bo'lsa kesh chetlab o'tiladi.
     """
+    missing = []
     for channel in MANDATORY_CHANNELS:
-        try:
-            member = await context.bot.get_chat_member(channel["id"], user_id)
-            if member.status not in ("member", "administrator", "creator"):
-                return False
-        except Exception as e:
-            logger.debug(f"[SUB CHECK ERROR] Kanal {channel['id']}: {e}")
+        cached = None if force else SUB_CACHE.get(channel["id"], user_id)
+        if cached is False:
             return False
-    return True
+        if cached is None:
+            missing.append(channel)
+    if not missing:
+        return True
+    results = await asyncio.gather(*(_fetch_membership(context.bot, ch, user_id) for ch in missing))
+    return all(results)
+
+async def chat_member_update_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Majburiy kanallarda kimdir qo'shilsa yoki chiqsa, keshni yangilaydi."""
+    cmu = update.chat_member
+    if not cmu:
+        return
+    user = cmu.new_chat_member.user
+    SUB_CACHE.put(cmu.chat.id, user.id, cmu.new_chat_member.status in SUB_MEMBER_STATUSES)
+    SUB_CACHE.updates += 1
     
 async def force_sub_if_private(update: Update, context: ContextTypes.DEFAULT_TYPE, lang_code=None) -> bool:
     if update.effective_chat.type != "private":
@@ -1913,13 +2667,10 @@ async def check_sub_button_handler(update: Update, context: ContextTypes.DEFAULT
     q = update.callback_query
     await q.answer()
     user_id = q.from_user.id
-    lang_code = DEFAULT_LANGUAGE
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", user_id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], user_id)
     lang = get_lang(lang_code)
-    if await check_subscription(user_id, context):
+    # Foydalanuvchi hozirgina obuna bo'lgan bo'lishi mumkin — kesh emas, Telegram'dan so'raladi
+    if await check_subscription(user_id, context, force=True):
         await q.edit_message_text(lang["sub_thanks"])
     else:
         kb = []
@@ -1931,48 +2682,535 @@ async def check_sub_button_handler(update: Update, context: ContextTypes.DEFAULT
         kb.append([InlineKeyboardButton(lang["sub_check"], callback_data="check_sub")])
         await q.edit_message_text(lang["sub_still_not"], reply_markup=InlineKeyboardMarkup(kb))
 
+# ---------------- Kunlik faollik bitmaplari ----------------
+# sessions jadvalidagi har bir xabar qatori o'rniga har kun uchun bitta ixcham bitmap saqlanadi.
+ACTIVITY_CHUNK_BITS = 16
+ACTIVITY_CHUNK_BYTES = (1 << ACTIVITY_CHUNK_BITS) // 8
+# Bo'lakda shundan ko'p foydalanuvchi bo'lgandagina zich bitmapga o'tiladi (xotirada ham, DB'da ham)
+ACTIVITY_ARRAY_MAX = ACTIVITY_CHUNK_BYTES // 2
+SESSIONS_RETENTION_DAYS = int(os.getenv("SESSIONS_RETENTION_DAYS", "30"))
+SESSIONS_RETENTION_BATCH = int(os.getenv("SESSIONS_RETENTION_BATCH", "10000"))
+SESSIONS_RETENTION_INTERVAL = int(os.getenv("SESSIONS_RETENTION_INTERVAL", "3600"))
+
+class ActivityBitmap:
+    """Roaring uslubidagi user_id to'plami. Har bir bo'lak (user_id >> 16) siyrak bo'lsa uint16
+    qiymatlar to'plami (set), ACTIVITY_ARRAY_MAX dan oshgandagina 65536 bitlik butun son sifatida saqlanadi.
+    Telegram id'lari siyrak, shuning uchun odatda bo'lakda bir nechta foydalanuvchi bo'ladi."""
+    __slots__ = ("chunks",)
+
+    def __init__(self, chunks=None):
+        self.chunks = chunks if chunks is not None else {}
+
+    def add(self, user_id):
+        hi, lo = user_id >> ACTIVITY_CHUNK_BITS, user_id & 0xFFFF
+        chunk = self.chunks.get(hi)
+        if chunk is None:
+            self.chunks[hi] = {lo}
+        elif isinstance(chunk, set):
+            chunk.add(lo)
+            if len(chunk) > ACTIVITY_ARRAY_MAX:
+                self.chunks[hi] = _chunk_dense(chunk)
+        else:
+            self.chunks[hi] = chunk | (1 << lo)
+
+    def __contains__(self, user_id):
+        chunk = self.chunks.get(user_id >> ACTIVITY_CHUNK_BITS)
+        if chunk is None:
+            return False
+        lo = user_id & 0xFFFF
+        return lo in chunk if isinstance(chunk, set) else bool(chunk >> lo & 1)
+
+    def __len__(self):
+        return sum(_chunk_len(chunk) for chunk in self.chunks.values())
+
+    def __or__(self, other):
+        chunks = dict(self.chunks)
+        for hi, chunk in other.chunks.items():
+            chunks[hi] = _chunk_or(chunks[hi], chunk) if hi in chunks else chunk
+        return ActivityBitmap(chunks)
+
+    def __and__(self, other):
+        chunks = {}
+        for hi, chunk in self.chunks.items():
+            if hi in other.chunks:
+                common = _chunk_and(chunk, other.chunks[hi])
+                if common:
+                    chunks[hi] = common
+        return ActivityBitmap(chunks)
+
+    @staticmethod
+    def encode_chunk(chunk):
+        if isinstance(chunk, set):
+            return b"\x00" + struct.pack(f">{len(chunk)}H", *sorted(chunk))
+        return b"\x01" + chunk.to_bytes(ACTIVITY_CHUNK_BYTES, "little")
+
+    @staticmethod
+    def decode_chunk(data):
+        if not data:
+            return set()
+        data = bytes(data)
+        if data[0] == 1:
+            return int.from_bytes(data[1:], "little")
+        return set(struct.unpack(f">{(len(data) - 1) // 2}H", data[1:]))
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls({r["chunk"]: cls.decode_chunk(r["bits"]) for r in rows})
+
+def _chunk_len(chunk):
+    return len(chunk) if isinstance(chunk, set) else chunk.bit_count()
+
+def _chunk_dense(values):
+    raw = bytearray(ACTIVITY_CHUNK_BYTES)
+    for v in values:
+        raw[v >> 3] |= 1 << (v & 7)
+    return int.from_bytes(raw, "little")
+
+def _chunk_or(a, b):
+    if isinstance(a, set) and isinstance(b, set):
+        merged = a | b
+        return _chunk_dense(merged) if len(merged) > ACTIVITY_ARRAY_MAX else merged
+    if isinstance(a, set):
+        a, b = b, a
+    # a — zich bitmap; b kichik to'plam bo'lsa bitlar bittalab qo'yiladi
+    return a | (_chunk_dense(b) if isinstance(b, set) else b)
+
+def _chunk_and(a, b):
+    if isinstance(a, set) and isinstance(b, set):
+        return a & b
+    if isinstance(a, set):
+        return {v for v in a if b >> v & 1}
+    if isinstance(b, set):
+        return {v for v in b if a >> v & 1}
+    return a & b
+
+def _chunk_union(chunks):
+    result = set()
+    for chunk in chunks:
+        result = _chunk_or(result, chunk)
+    return result
+
+async def merge_activity(conn, day, user_ids):
+    """user_ids ni kun bitmapiga qo'shadi. Tranzaksiya ichida chaqirilishi kerak: bo'lak qatorlari
+    bloklanadi, shuning uchun bir vaqtda yozayotgan jarayonlar bir-birining bitlarini o'chirmaydi."""
+    bm = ActivityBitmap()
+    for user_id in user_ids:
+        bm.add(int(user_id))
+    chunks = sorted(bm.chunks)
+    if not chunks:
+        return
+    await conn.executemany(
+        "INSERT INTO daily_activity(tashkent_day, chunk, bits) VALUES($1, $2, ''::bytea) "
+        "ON CONFLICT (tashkent_day, chunk) DO NOTHING",
+        [(day, hi) for hi in chunks]
+    )
+    rows = await conn.fetch(
+        "SELECT chunk, bits FROM daily_activity WHERE tashkent_day=$1 AND chunk = ANY($2::bigint[]) "
+        "ORDER BY chunk FOR UPDATE",
+        day, chunks
+    )
+    updates = []
+    for r in rows:
+        old = ActivityBitmap.decode_chunk(r["bits"])
+        merged = _chunk_or(old, bm.chunks[r["chunk"]])
+        # OR faqat qo'shadi — soni o'zgarmasa yangi bit yo'q
+        if _chunk_len(merged) != _chunk_len(old) or not r["bits"]:
+            updates.append((day, r["chunk"], ActivityBitmap.encode_chunk(merged)))
+    if updates:
+        await conn.executemany(
+            "UPDATE daily_activity SET bits=$3 WHERE tashkent_day=$1 AND chunk=$2", updates
+        )
+
+async def activity_day_counts(conn, first_day, last_day):
+    """Har kun uchun faol foydalanuvchilar soni. Massiv bo'laklar SQL'da sanaladi,
+    faqat zich bitmaplar (kamdan-kam) Python'ga olinadi."""
+    rows = await conn.fetch(
+        "SELECT tashkent_day, "
+        "       COALESCE(SUM((length(bits) - 1) / 2) FILTER (WHERE get_byte(bits, 0) = 0), 0) AS sparse, "
+        "       array_agg(bits) FILTER (WHERE get_byte(bits, 0) = 1) AS dense "
+        "FROM daily_activity WHERE tashkent_day BETWEEN $1 AND $2 AND length(bits) > 0 "
+        "GROUP BY tashkent_day",
+        first_day, last_day
+    )
+    return {
+        r["tashkent_day"]: int(r["sparse"]) + sum(ActivityBitmap.decode_chunk(b).bit_count() for b in r["dense"] or ())
+        for r in rows
+    }
+
+async def activity_summary(pool, today=None):
+    """DAU/WAU/MAU va D1/D7 qaytish. Bo'laklar kursor orqali bittalab o'qiladi: xotirada bir vaqtda
+    faqat bitta bo'lakning 30 kunlik qiymatlari turadi."""
+    today = today or tashkent_today()
+    week_start = today - timedelta(days=6)
+    day1, day7 = today - timedelta(days=1), today - timedelta(days=7)
+    totals = {"dau": 0, "wau": 0, "mau": 0, "d1_cohort": 0, "d1_kept": 0, "d7_cohort": 0, "d7_kept": 0}
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            async for r in conn.cursor(
+                "SELECT chunk, array_agg(tashkent_day) AS days, array_agg(bits) AS bits "
+                "FROM daily_activity WHERE tashkent_day BETWEEN $1 AND $2 GROUP BY chunk",
+                today - timedelta(days=29), today
+            ):
+                chunks = {day: ActivityBitmap.decode_chunk(bits) for day, bits in zip(r["days"], r["bits"])}
+                totals["mau"] += _chunk_len(_chunk_union(chunks.values()))
+                totals["wau"] += _chunk_len(_chunk_union(c for d, c in chunks.items() if d >= week_start))
+                current = chunks.get(today)
+                if current:
+                    totals["dau"] += _chunk_len(current)
+                for cohort_day, prefix in ((day1, "d1"), (day7, "d7")):
+                    cohort = chunks.get(cohort_day)
+                    if cohort:
+                        totals[f"{prefix}_cohort"] += _chunk_len(cohort)
+                        if current:
+                            totals[f"{prefix}_kept"] += _chunk_len(_chunk_and(cohort, current))
+
+    def retention(prefix):
+        cohort = totals[f"{prefix}_cohort"]
+        return totals[f"{prefix}_kept"] / cohort if cohort else None
+
+    return {
+        "dau": totals["dau"],
+        "wau": totals["wau"],
+        "mau": totals["mau"],
+        "d1": retention("d1"),
+        "d7": retention("d7"),
+    }
+
+async def migrate_sessions_to_activity(conn):
+    """Eski sessions qatorlarini bir marta kunlik bitmaplarga ko'chiradi."""
+    async with conn.transaction():
+        done = await conn.fetchval("SELECT value FROM meta WHERE key = 'sessions_migrated' FOR UPDATE")
+        if done:
+            return
+        days = 0
+        async for r in conn.cursor(
+            "SELECT (started_at AT TIME ZONE 'Asia/Tashkent')::date AS day, array_agg(DISTINCT user_id) AS ids "
+            "FROM sessions WHERE user_id IS NOT NULL AND started_at IS NOT NULL GROUP BY 1"
+        ):
+            await merge_activity(conn, r["day"], r["ids"])
+            days += 1
+        await conn.execute(
+            "INSERT INTO meta(key, value) VALUES('sessions_migrated', $1) "
+            "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+            str(int(time.time()))
+        )
+        logger.info(f"✅ sessions -> daily_activity: {days} kun ko'chirildi")
+
+async def sessions_retention_loop(pool):
+    """Ko'chirilgan sessions qatorlarini kichik partiyalarda o'chiradi."""
+    while True:
+        try:
+            deleted = 0
+            cutoff = utc_now() - timedelta(days=SESSIONS_RETENTION_DAYS)
+            while True:
+                async with pool.acquire() as conn:
+                    status = await conn.execute(
+                        "DELETE FROM sessions WHERE id IN ("
+                        "  SELECT id FROM sessions WHERE started_at < $1 LIMIT $2"
+                        ")",
+                        cutoff, SESSIONS_RETENTION_BATCH
+                    )
+                n = int(status.split()[-1])
+                deleted += n
+                if n < SESSIONS_RETENTION_BATCH:
+                    break
+                await asyncio.sleep(0.5)
+            if deleted:
+                logger.info(f"[SESSIONS RETENTION] {deleted} ta eski qator o'chirildi")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"[SESSIONS RETENTION] {e}")
+        await asyncio.sleep(SESSIONS_RETENTION_INTERVAL)
+
+# ---------------- Write-behind bufer ----------------
+# Generatsiya loglari, kunlik faollik va last_seen yangilanishlari xotirada yig'iladi va
+# har WRITE_BEHIND_FLUSH_MS yoki WRITE_BEHIND_FLUSH_ROWS qatorda bitta ulanishda yoziladi.
+WRITE_BEHIND_FLUSH_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", "1000"))
+WRITE_BEHIND_FLUSH_ROWS = int(os.getenv("WRITE_BEHIND_FLUSH_ROWS", "500"))
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "20000"))
+# Ulanish xatosida partiya shuncha flush davomida qayta urinadi, keyin qatorma-qator yoziladi
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "30"))
+
+GENERATION_LOG_COLUMNS = ["user_id", "username", "prompt", "translated_prompt", "image_id", "image_count", "created_at"]
+
+def _is_transient_db_error(e):
+    """Ulanish/server holati bilan bog'liq xato — ma'lumotning o'zida emas."""
+    return isinstance(e, (
+        OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError,
+        asyncpg.OperatorInterventionError, asyncpg.InsufficientResourcesError,
+    ))
+
+class WriteBehindBuffer:
+    def __init__(self, flush_ms, flush_rows, max_rows):
+        self.flush_interval = max(flush_ms, 10) / 1000
+        self.flush_rows = max(int(flush_rows), 1)
+        self.max_rows = max(int(max_rows), self.flush_rows)
+        self.pool = None
+        self._generations = []
+        self._activity = {}
+        self._activity_size = 0
+        # Bugun shu jarayonda allaqachon belgilangan foydalanuvchilar (takroriy yozuvlarsiz)
+        self._marked_day = None
+        self._marked = set()
+        self._last_seen = {}
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        # Ketma-ket muvaffaqiyatsiz flushlar soni
+        self._retries = 0
+        self.stats = {"flushes": 0, "rows": 0, "dropped": 0, "errors": 0, "max_size": 0}
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def size(self):
+        return len(self._generations) + self._activity_size + len(self._last_seen)
+
+    def _added(self):
+        size = self.size()
+        self.stats["max_size"] = max(self.stats["max_size"], size)
+        if size >= self.flush_rows:
+            self._wake.set()
+
+    def add_generation(self, record):
+        """Generatsiya logini buferga qo'shadi. Bufer to'la bo'lsa False — chaqiruvchi o'zi yozadi."""
+        if not self.running or self.size() >= self.max_rows:
+            return False
+        self._generations.append(record)
+        self._added()
+        return True
+
+    def mark_active(self, user_id, day):
+        if day != self._marked_day:
+            self._marked_day = day
+            self._marked = set()
+        if user_id in self._marked:
+            return
+        if self.size() >= self.max_rows:
+            self.stats["dropped"] += 1
+            return
+        if len(self._marked) < USER_CACHE_SIZE:
+            self._marked.add(user_id)
+        self._add_activity(day, [user_id])
+        self._added()
+
+    def _add_activity(self, day, user_ids):
+        bucket = self._activity.setdefault(day, set())
+        before = len(bucket)
+        bucket.update(user_ids)
+        self._activity_size += len(bucket) - before
+
+    def touch(self, user_id, seen_at):
+        # Bir foydalanuvchi uchun faqat eng so'nggi vaqt saqlanadi
+        if user_id not in self._last_seen and self.size() >= self.max_rows:
+            self.stats["dropped"] += 1
+            return
+        prev = self._last_seen.get(user_id)
+        if prev is None or seen_at > prev:
+            self._last_seen[user_id] = seen_at
+        self._added()
+
+    def start(self, pool):
+        self.pool = pool
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.size() or self.pool is None:
+                return
+            generations, self._generations = self._generations, []
+            activity, self._activity = self._activity, {}
+            activity_size, self._activity_size = self._activity_size, 0
+            last_seen, self._last_seen = self._last_seen, {}
+
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await self._write_generations(conn, generations)
+                        await self._write_rest(conn, activity, last_seen)
+                self._retries = 0
+                self.stats["flushes"] += 1
+                self.stats["rows"] += len(generations) + activity_size + len(last_seen)
+                return
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"[WRITE BEHIND] Flush xatosi: {e}")
+                transient = _is_transient_db_error(e)
+
+            if transient and self._retries < WRITE_BEHIND_MAX_RETRIES:
+                # Ulanish muammosi — partiya keyingi flushga qaytariladi (joy bo'lsa)
+                self._retries += 1
+                self._requeue(generations, activity, activity_size, last_seen)
+                return
+            # Ma'lumot xatosi yoki qayta urinishlar tugadi: qatorma-qator, yozilmaganlari tashlanadi
+            self._retries = 0
+            left = generations
+            try:
+                async with self.pool.acquire() as conn:
+                    left = await self._write_generations_one_by_one(conn, generations)
+                    try:
+                        async with conn.transaction():
+                            await self._write_rest(conn, activity, last_seen)
+                        self.stats["rows"] += activity_size + len(last_seen)
+                        activity, activity_size, last_seen = {}, 0, {}
+                    except Exception as e:
+                        if not _is_transient_db_error(e):
+                            logger.error(f"[WRITE BEHIND] Faollik/last_seen yozilmadi, tashlandi: {e}")
+                            self.stats["dropped"] += activity_size + len(last_seen)
+                            activity, activity_size, last_seen = {}, 0, {}
+                        else:
+                            raise
+            except Exception as e:
+                logger.warning(f"[WRITE BEHIND] Qatorma-qator yozishda ulanish xatosi: {e}")
+            self._requeue(left, activity, activity_size, last_seen)
+
+    async def _write_generations(self, conn, generations):
+        if not generations:
+            return
+        totals = {}
+        for r in generations:
+            totals[r[0]] = totals.get(r[0], 0) + int(r[5] or 0)
+        await conn.copy_records_to_table(
+            "generations", records=generations, columns=GENERATION_LOG_COLUMNS
+        )
+        await conn.executemany(
+            "UPDATE users SET total_images = COALESCE(total_images, 0) + $2 WHERE id = $1",
+            list(totals.items())
+        )
+
+    async def _write_rest(self, conn, activity, last_seen):
+        for day, user_ids in sorted(activity.items()):
+            await merge_activity(conn, day, user_ids)
+        if last_seen:
+            await conn.executemany(
+                "UPDATE users SET last_seen = GREATEST(COALESCE(last_seen, $2), $2) WHERE id = $1",
+                list(last_seen.items())
+            )
+
+    async def _write_generations_one_by_one(self, conn, generations):
+        """Har qator alohida tranzaksiyada. Yaroqsiz qator log qilinib tashlanadi;
+        ulanish uzilsa yozilmagan qolgan qatorlar qaytariladi."""
+        for i, row in enumerate(generations):
+            try:
+                async with conn.transaction():
+                    await self._write_generations(conn, [row])
+                self.stats["rows"] += 1
+            except Exception as e:
+                if _is_transient_db_error(e):
+                    return generations[i:]
+                self.stats["dropped"] += 1
+                logger.error(f"[WRITE BEHIND] Generatsiya logi yozilmadi, tashlandi (user={row[0]}, image_id={row[4]}): {e}")
+        return []
+
+    def _requeue(self, generations, activity, activity_size, last_seen):
+        # Joy bo'lsa keyingi flushga qaytaramiz, aks holda tashlaymiz — bufer max_rows dan oshmaydi
+        if generations:
+            room = max(self.max_rows - self.size(), 0)
+            if len(generations) > room:
+                self.stats["dropped"] += len(generations) - room
+                generations = generations[len(generations) - room:] if room else []
+            self._generations[:0] = generations
+        if activity:
+            if self.size() + activity_size <= self.max_rows:
+                for day, user_ids in activity.items():
+                    self._add_activity(day, user_ids)
+            else:
+                self.stats["dropped"] += activity_size
+        for user_id, seen_at in last_seen.items():
+            self.touch(user_id, seen_at)
+
+    def stats_line(self):
+        s = self.stats
+        return (
+            f"{self.size()} kutmoqda (max {s['max_size']}), {s['flushes']} flush, "
+            f"{s['rows']} qator, xato {s['errors']}, tashlangan {s['dropped']}"
+        )
+
+WRITE_BEHIND = WriteBehindBuffer(WRITE_BEHIND_FLUSH_MS, WRITE_BEHIND_FLUSH_ROWS, WRITE_BEHIND_MAX_ROWS)
+
 # ---------------- DB user/session/logging ----------------
+# Bitta statement: yangi foydalanuvchi yoziladi yoki mavjudi yangilanadi.
+# Matn o'zgarmas — asyncpg uni har ulanishda bir marta prepare qiladi.
+UPSERT_USER_SQL = (
+    "INSERT INTO users(id, username, first_seen, last_seen, language_code, image_model_id) "
+    "VALUES($1, $2, $3, $3, COALESCE($4, $6), COALESCE($5, '')) "
+    "ON CONFLICT (id) DO UPDATE SET "
+    "username = EXCLUDED.username, "
+    "last_seen = GREATEST(COALESCE(users.last_seen, EXCLUDED.last_seen), EXCLUDED.last_seen), "
+    "language_code = COALESCE($4, users.language_code), "
+    "image_model_id = COALESCE($5, users.image_model_id)"
+)
+# last_seen shu soniyadan eski bo'lsagina yangilanadi
+USER_TOUCH_DEBOUNCE = float(os.getenv("USER_TOUCH_DEBOUNCE", "60"))
+# user_id -> (oxirgi yozuv vaqti (monotonic), username)
+_USER_TOUCHES = OrderedDict()
+
+def _remember_user_touch(user_id, username):
+    _USER_TOUCHES[user_id] = (time.monotonic(), username)
+    _USER_TOUCHES.move_to_end(user_id)
+    while len(_USER_TOUCHES) > USER_CACHE_SIZE:
+        _USER_TOUCHES.popitem(last=False)
+
 async def add_user_db(pool, tg_user, lang_code=None, image_model_id=None):
     now = utc_now()
+    username = tg_user.username if tg_user.username else None
+    # Til yoki model o'zgarsa, boshqa jarayonlar ham bilishi kerak
+    settings_changed = lang_code is not None or image_model_id is not None
+    touch = _USER_TOUCHES.get(tg_user.id)
+    if not settings_changed and touch and touch[1] == username and WRITE_BEHIND.running:
+        # Ma'lum foydalanuvchi, username o'zgarmagan: DB ga bormaymiz
+        if time.monotonic() - touch[0] >= USER_TOUCH_DEBOUNCE:
+            WRITE_BEHIND.touch(tg_user.id, now)
+            _remember_user_touch(tg_user.id, username)
+        WRITE_BEHIND.mark_active(tg_user.id, tashkent_today(now))
+        return
+
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT id FROM users WHERE id = $1", tg_user.id)
-        if row:
-            updates = []
-            params = []
-            idx = 1
-            if lang_code is not None:
-                updates.append(f"language_code=${idx}")
-                params.append(lang_code)
-                idx += 1
-            if image_model_id is not None:
-                updates.append(f"image_model_id=${idx}")
-                params.append(image_model_id)
-                idx += 1
-            updates.append(f"username=${idx}")
-            updates.append(f"last_seen=${idx+1}")
-            params.extend([tg_user.username if tg_user.username else None, now, tg_user.id])
-            if updates:
-                query = f"UPDATE users SET {', '.join(updates)} WHERE id=${len(params)}"
-                await conn.execute(query, *params)
+        await conn.execute(UPSERT_USER_SQL, tg_user.id, username, now, lang_code, image_model_id, DEFAULT_LANGUAGE)
+        if WRITE_BEHIND.running:
+            WRITE_BEHIND.mark_active(tg_user.id, tashkent_today(now))
         else:
-            lang_code = lang_code or DEFAULT_LANGUAGE
-            image_model_id = image_model_id or ""
-            await conn.execute(
-                "INSERT INTO users(id, username, first_seen, last_seen, language_code, image_model_id) "
-                "VALUES($1,$2,$3,$4,$5,$6)",
-                tg_user.id, tg_user.username if tg_user.username else None,
-                now, now, lang_code, image_model_id
-            )
-        await conn.execute("INSERT INTO sessions(user_id, started_at) VALUES($1,$2)", tg_user.id, now)
+            async with conn.transaction():
+                await merge_activity(conn, tashkent_today(now), [tg_user.id])
+        if settings_changed or touch is None or touch[1] != username:
+            await invalidate_user(conn, tg_user.id, broadcast=settings_changed)
+    _remember_user_touch(tg_user.id, username)
 
 async def log_generation(pool, tg_user, prompt, translated, image_id, count):
     now = utc_now()
+    record = (
+        tg_user.id, tg_user.username if tg_user.username else None,
+        prompt, translated, image_id, count, now
+    )
+    if WRITE_BEHIND.add_generation(record):
+        return
     async with pool.acquire() as conn:
         await conn.execute(
             "INSERT INTO generations(user_id, username, prompt, translated_prompt, image_id, image_count, created_at) "
             "VALUES($1,$2,$3,$4,$5,$6,$7)",
-            tg_user.id, tg_user.username if tg_user.username else None,
-            prompt, translated, image_id, count, now
+            *record
+        )
+        await conn.execute(
+            "UPDATE users SET total_images = COALESCE(total_images, 0) + $2 WHERE id = $1",
+            tg_user.id, count
         )
 
 #-------------Sozlamalar--------------------
@@ -1980,16 +3218,9 @@ async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     user_id = q.from_user.id
-    lang_code = DEFAULT_LANGUAGE
-    image_model_id = ""
-    
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT language_code, image_model_id FROM users WHERE id = $1", user_id
-        )
-        if row:
-            lang_code = row["language_code"] or DEFAULT_LANGUAGE
-            image_model_id = row["image_model_id"] or ""
+    profile = await get_user_profile(context.application.bot_data["db_pool"], user_id)
+    lang_code = (profile.language_code if profile else None) or DEFAULT_LANGUAGE
+    image_model_id = (profile.image_model_id if profile else None) or ""
 
     lang = get_lang(lang_code)
     current_model_title = "Default Mode"
@@ -2065,15 +3296,9 @@ async def set_image_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Eski xabarni tahrirlash o'rniga, yangi xabar yuborish
     user_id = user.id
-    lang_code = DEFAULT_LANGUAGE
-    image_model_id = ""
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT language_code, image_model_id FROM users WHERE id = $1", user_id
-        )
-        if row:
-            lang_code = row["language_code"] or DEFAULT_LANGUAGE
-            image_model_id = row["image_model_id"] or ""
+    profile = await get_user_profile(context.application.bot_data["db_pool"], user_id)
+    lang_code = (profile.language_code if profile else None) or DEFAULT_LANGUAGE
+    image_model_id = (profile.image_model_id if profile else None) or ""
 
     lang = get_lang(lang_code)
     current_model_title = "Default Mode"
@@ -2188,11 +3413,7 @@ async def notify_admin_generation(context: ContextTypes.DEFAULT_TYPE, user, prom
 
     try:
         # Foydalanuvchi tilini olish
-        lang_code = DEFAULT_LANGUAGE
-        async with context.application.bot_data["db_pool"].acquire() as conn:
-            row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", ADMIN_ID)
-            if row:
-                lang_code = row["language_code"]
+        lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], ADMIN_ID)
         lang = get_lang(lang_code)
 
         tashkent_dt = tashkent_time()
@@ -2247,11 +3468,7 @@ async def notify_admin_on_error(
         return
 
     try:
-        lang_code = DEFAULT_LANGUAGE
-        async with context.application.bot_data["db_pool"].acquire() as conn:
-            row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", ADMIN_ID)
-            if row:
-                lang_code = row["language_code"]
+        lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], ADMIN_ID)
         lang = get_lang(lang_code)
 
         tashkent_dt = tashkent_time()
@@ -2299,10 +3516,7 @@ async def cmd_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     lang_code = DEFAULT_LANGUAGE
     if update.effective_chat.type == "private":
-        async with context.application.bot_data["db_pool"].acquire() as conn:
-            row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", update.effective_user.id)
-            if row:
-                lang_code = row["language_code"]
+        lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], update.effective_user.id)
     lang = get_lang(lang_code)
     if update.callback_query:
         await update.callback_query.answer()
@@ -2354,11 +3568,7 @@ async def language_select_handler(update: Update, context: ContextTypes.DEFAULT_
 
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    lang_code = None
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", user_id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], user_id)
     lang = get_lang(lang_code)
     kb = [
         [
@@ -2399,11 +3609,7 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_ai_flow_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    lang_code = DEFAULT_LANGUAGE
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", q.from_user.id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], q.from_user.id)
     lang = get_lang(lang_code)
     # Faqat bitta marta, tarjima qilingan xabarni yuborish
     await q.message.reply_text(lang["ai_prompt_text"])
@@ -2416,11 +3622,7 @@ async def start_ai_flow_handler(update: Update, context: ContextTypes.DEFAULT_TY
 async def handle_start_gen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    lang_code = DEFAULT_LANGUAGE
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", q.from_user.id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], q.from_user.id)
     lang = get_lang(lang_code)
     await q.message.reply_text(lang["prompt_text"])
     # flow o'zgaruvchisini o'rnatamiz
@@ -2434,10 +3636,7 @@ async def handle_change_language(update: Update, context: ContextTypes.DEFAULT_T
 async def cmd_get(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang_code = DEFAULT_LANGUAGE
     if update.effective_chat.type == "private":
-        async with context.application.bot_data["db_pool"].acquire() as conn:
-            row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", update.effective_user.id)
-            if row:
-                lang_code = row["language_code"]
+        lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], update.effective_user.id)
     lang = get_lang(lang_code)
     if not await force_sub_if_private(update, context, lang_code):
         return
@@ -2455,6 +3654,9 @@ async def cmd_get(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await add_user_db(context.application.bot_data["db_pool"], update.effective_user)
     context.user_data["prompt"] = prompt
     context.user_data["translated"] = prompt
+    stale = context.user_data.pop("translation_task", None)
+    if stale and not stale.done():
+        stale.cancel()
 
     # Tugmalarni yonma-yon qilish uchun bitta qatorga joylashtiramiz
     kb = [
@@ -2472,19 +3674,1214 @@ async def cmd_get(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup=InlineKeyboardMarkup(kb)
 )
 
+# ---------------- Gemini kalitlar puli ----------------
+# Har bir kalit va maqsad (tarjima / chat / xulosa) uchun RPM/TPM byudjeti daqiqalik oynada kuzatiladi,
+# shuning uchun chatdagi to'lqin rasm pipeline'idagi tarjimani to'xtatib qo'ymaydi.
+# Standart taqsimot: har bir (kalit, model) uchun daqiqalik limit Google'ning 429 javobidan o'rganiladi
+# (yoki GEMINI_KEY_RPM bilan beriladi) va uning GEMINI_TRANSLATE_RESERVE ulushi tarjima uchun saqlanadi —
+# chat va xulosa past ustuvorlikda qolgan qismini ishlatadi. Maqsad bo'yicha RPM/TPM env'lari faqat
+# qo'shimcha qat'iy cheklov; so'rovlar eng kam yuklangan kalitga yuboriladi.
+def _budget_env(name):
+    value = os.getenv(name, "").strip()
+    return int(value) if value else None
+
+GEMINI_BUDGETS = {
+    "translate": {
+        "rpm": _budget_env("GEMINI_TRANSLATE_RPM"),
+        "tpm": _budget_env("GEMINI_TRANSLATE_TPM"),
+    },
+    "chat": {
+        "rpm": _budget_env("GEMINI_CHAT_RPM"),
+        "tpm": _budget_env("GEMINI_CHAT_TPM"),
+    },
+    # AI chat xotirasini fonda xulosalash
+    "summary": {
+        "rpm": _budget_env("GEMINI_SUMMARY_RPM"),
+        "tpm": _budget_env("GEMINI_SUMMARY_TPM"),
+    },
+}
+GEMINI_PRIORITY_PURPOSE = "translate"
+GEMINI_TRANSLATE_RESERVE = float(os.getenv("GEMINI_TRANSLATE_RESERVE", "0.3"))
+GEMINI_KEY_RPM = _budget_env("GEMINI_KEY_RPM")
+# O'rganilgan limit shuncha vaqtdan keyin unutiladi — tarif oshgan bo'lsa qayta sinab ko'riladi
+GEMINI_KEY_LIMIT_TTL = float(os.getenv("GEMINI_KEY_LIMIT_TTL", "600"))
+GEMINI_KEY_COOLDOWN_RATE = float(os.getenv("GEMINI_KEY_COOLDOWN_RATE", "60"))
+GEMINI_KEY_ACQUIRE_TIMEOUT = float(os.getenv("GEMINI_KEY_ACQUIRE_TIMEOUT", "10"))
+
+class GeminiBudgetExceeded(Exception):
+    pass
+
+class GeminiKey:
+    def __init__(self, index, api_key):
+        self.api_key = api_key
+        self.label = f"#{index + 1} {_mask_token(api_key)}"
+        self._client = None
+        # purpose -> deque([[vaqt, token], ...]) — oxirgi 60 soniya
+        self.windows = {purpose: deque() for purpose in GEMINI_BUDGETS}
+        # Google kvotasi model bo'yicha: 429 faqat shu model uchun kalitni dam oldiradi
+        self.cooldowns = {}
+        # model -> deque([vaqt, ...]) — barcha maqsadlar bo'yicha; model -> (rpm, amal qilish muddati)
+        self.model_windows = {}
+        self.model_limits = {}
+        self.ok = 0
+        self.fail = 0
+        self.rate_limited = 0
+
+    @property
+    def client(self):
+        # gRPC asyncio klienti event loop ichida yaratiladi
+        if self._client is None:
+            self._client = glm.GenerativeServiceAsyncClient(client_options={"api_key": self.api_key})
+        return self._client
+
+    def usage(self, purpose, now):
+        window = self.windows[purpose]
+        while window and window[0][0] <= now - 60:
+            window.popleft()
+        return len(window), sum(entry[1] for entry in window)
+
+    def cooldown_left(self, model_name, now):
+        return max(self.cooldowns.get(model_name, 0.0) - now, 0.0)
+
+    def model_usage(self, model_name, now):
+        window = self.model_windows.get(model_name)
+        if not window:
+            return 0
+        while window and window[0] <= now - 60:
+            window.popleft()
+        return len(window)
+
+    def rpm_limit(self, model_name, now):
+        if GEMINI_KEY_RPM:
+            return GEMINI_KEY_RPM
+        learned = self.model_limits.get(model_name)
+        if learned and learned[1] > now:
+            return learned[0]
+        return None
+
+    def learn_limit(self, model_name, now):
+        # 429 kelgan paytdagi so'rovlar soni (shu so'rovsiz) — kalitning haqiqiy limiti
+        limit = max(self.model_usage(model_name, now) - 1, 1)
+        self.model_limits[model_name] = (limit, now + GEMINI_KEY_LIMIT_TTL)
+        return limit
+
+    def lane_cap(self, purpose, model_name, now):
+        limit = self.rpm_limit(model_name, now)
+        if not limit:
+            return None
+        if purpose == GEMINI_PRIORITY_PURPOSE:
+            return limit
+        return max(limit * (1 - GEMINI_TRANSLATE_RESERVE), 1)
+
+    def headroom(self, purpose, tokens, now, model_name=None):
+        """Bo'sh byudjet ulushi (0..1); sig'masa None."""
+        if self.cooldown_left(model_name, now):
+            return None
+        budget = GEMINI_BUDGETS[purpose]
+        requests, used_tokens = self.usage(purpose, now)
+        shares = []
+        cap = self.lane_cap(purpose, model_name, now)
+        if cap:
+            lane_left = cap - self.model_usage(model_name, now)
+            if lane_left <= 0:
+                return None
+            shares.append(lane_left / cap)
+        if budget["rpm"]:
+            rpm_left = budget["rpm"] - requests
+            if rpm_left <= 0:
+                return None
+            shares.append(rpm_left / budget["rpm"])
+        if budget["tpm"]:
+            tpm_left = budget["tpm"] - used_tokens
+            if tpm_left < tokens:
+                return None
+            shares.append(tpm_left / budget["tpm"])
+        # Cheklov berilmagan — oxirgi daqiqada kam ishlatilgan kalit afzal
+        return min(shares) if shares else 1 / (1 + requests)
+
+    def next_free_in(self, purpose, now, model_name=None):
+        waits = []
+        if self.cooldown_left(model_name, now):
+            waits.append(self.cooldown_left(model_name, now))
+        window = self.windows[purpose]
+        if window:
+            waits.append(window[0][0] + 60 - now)
+        cap = self.lane_cap(purpose, model_name, now)
+        if cap and self.model_usage(model_name, now) >= cap:
+            waits.append(self.model_windows[model_name][0] + 60 - now)
+        return max(waits) if waits else 0.0
+
+class GeminiKeyPool:
+    def __init__(self, api_keys):
+        self.keys = [GeminiKey(i, k) for i, k in enumerate(api_keys)]
+        self.waits = {purpose: 0 for purpose in GEMINI_BUDGETS}
+
+    async def acquire(self, purpose, tokens, model_name=None, timeout=GEMINI_KEY_ACQUIRE_TIMEOUT, exclude=()):
+        """Eng ko'p bo'sh joyi bor kalitni tanlaydi va so'rovni uning oynasiga yozadi."""
+        if not self.keys:
+            raise GeminiBudgetExceeded("Gemini kaliti sozlanmagan")
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            now = time.monotonic()
+            best, best_room = None, None
+            for key in self.keys:
+                if key in exclude:
+                    continue
+                room = key.headroom(purpose, tokens, now, model_name)
+                if room is not None and (best_room is None or room > best_room):
+                    best, best_room = key, room
+            if best:
+                entry = [now, tokens]
+                best.windows[purpose].append(entry)
+                best.model_windows.setdefault(model_name, deque()).append(now)
+                return best, entry
+            candidates = [k for k in self.keys if k not in exclude]
+            remaining = deadline - now
+            if not candidates or remaining <= 0:
+                raise GeminiBudgetExceeded(f"Gemini {purpose} byudjeti tugadi")
+            if not waited:
+                self.waits[purpose] += 1
+                waited = True
+            wait = min(k.next_free_in(purpose, now, model_name) for k in candidates)
+            await asyncio.sleep(min(max(wait, 0.05), remaining))
+
+    def model_available(self, model_name):
+        now = time.monotonic()
+        return any(not key.cooldown_left(model_name, now) for key in self.keys)
+
+    def record(self, key, entry, model_name=None, tokens_used=None, rate_limited=False, ok=True):
+        if tokens_used is not None:
+            entry[1] = tokens_used
+        if rate_limited:
+            now = time.monotonic()
+            key.rate_limited += 1
+            key.cooldowns[model_name] = now + GEMINI_KEY_COOLDOWN_RATE
+            learned = "" if GEMINI_KEY_RPM else f", limit ≈ {key.learn_limit(model_name, now)} rpm"
+            logger.warning(
+                f"[GEMINI KEY] {key.label} {model_name} 429, {int(GEMINI_KEY_COOLDOWN_RATE)}s dam oladi{learned}"
+            )
+        # ok=None — natija noma'lum (so'rov bekor qilingan), hisoblanmaydi
+        if ok:
+            key.ok += 1
+        elif ok is not None:
+            key.fail += 1
+
+    def stats_lines(self):
+        now = time.monotonic()
+        lines = []
+        for key in self.keys:
+            cooling = [f"{m} {int(left)}s" for m in key.cooldowns if (left := key.cooldown_left(m, now))]
+            state = f"⏸ {', '.join(cooling)}" if cooling else "✅"
+            usage = []
+            for purpose, budget in GEMINI_BUDGETS.items():
+                requests, tokens = key.usage(purpose, now)
+                rpm = budget["rpm"] or "∞"
+                tpm = f"{budget['tpm'] // 1000}k" if budget["tpm"] else "∞"
+                usage.append(f"{purpose} {requests}/{rpm} rpm, {tokens // 1000}k/{tpm} tpm")
+            for model_name in key.model_windows:
+                if (limit := key.rpm_limit(model_name, now)):
+                    usage.append(f"{model_name} {key.model_usage(model_name, now)}/{limit} rpm")
+            lines.append(
+                f"{state} `{key.label}` | {'; '.join(usage)} | ok {key.ok} / xato {key.fail} / 429 {key.rate_limited}"
+            )
+        return lines
+
+def _gemini_client_hook_ok():
+    """Kalitga xos klient GenerativeModel._async_client orqali beriladi (ochiq API yo'q).
+    requirements.txt da google-generativeai 0.8.6 ga qotirilgan; boshqa versiyada hook ishlamasa
+    so'rovlar genai.configure() dagi birinchi kalitga ketadi."""
+    try:
+        source = inspect.getsource(genai.GenerativeModel.generate_content_async)
+    except (OSError, TypeError):
+        return False
+    return "self._async_client" in source and hasattr(genai.GenerativeModel("gemini-2.0-flash"), "_async_client")
+
+GEMINI_CLIENT_HOOK = _gemini_client_hook_ok()
+if not GEMINI_CLIENT_HOOK and len(GEMINI_API_KEYS) > 1:
+    # Byudjet boshqa kalitlarga yozilib, so'rov birinchisiga ketmasligi uchun pul bitta kalit bilan ishlaydi
+    logger.error(
+        f"[GEMINI KEY] google-generativeai {genai.__version__}: _async_client hook ishlamaydi — faqat birinchi kalit ishlatiladi"
+    )
+GEMINI_KEYS = GeminiKeyPool(GEMINI_API_KEYS if GEMINI_CLIENT_HOOK else GEMINI_API_KEYS[:1])
+
+def _estimate_tokens(text, max_output_tokens):
+    # Taxminan 4 belgi = 1 token; javob uchun maksimal chiqish hisoblanadi
+    return len(text) // 4 + 1 + max_output_tokens
+
+# ---------------- Gemini model yo'naltirish ----------------
+# Har bir maqsad uchun modellar tartibi: birinchisi asosiy, qolganlari xato yoki kvota tugaganda zaxira.
+# Qisqa (100 token) tarjima uchun tezroq va arzonroq lite model, chat uchun to'liq model.
+GEMINI_MODEL_TIERS = {
+    "translate": [m.strip() for m in os.getenv("GEMINI_TRANSLATE_MODELS", "gemini-2.0-flash-lite,gemini-2.0-flash").split(",") if m.strip()],
+    "chat": [m.strip() for m in os.getenv("GEMINI_CHAT_MODELS", "gemini-2.0-flash,gemini-2.0-flash-lite").split(",") if m.strip()],
+    "summary": [m.strip() for m in os.getenv("GEMINI_SUMMARY_MODELS", "gemini-2.0-flash-lite,gemini-2.0-flash").split(",") if m.strip()],
+}
+# (model nomi, kalit) -> GenerativeModel; har xabar uchun yangi obyekt yaratilmaydi
+_GEMINI_MODELS = {}
+GEMINI_MODEL_STATS = {}
+
+def _gemini_model(model_name, key):
+    cache_key = (model_name, key.api_key)
+    model = _GEMINI_MODELS.get(cache_key)
+    if model is None:
+        model = genai.GenerativeModel(model_name)
+        # Hook ishlamasa pulda faqat birinchi kalit bor — u genai.configure() dagi standart klient
+        if GEMINI_CLIENT_HOOK:
+            model._async_client = key.client
+        _GEMINI_MODELS[cache_key] = model
+    return model
+
+def _gemini_model_stats(model_name):
+    stats = GEMINI_MODEL_STATS.get(model_name)
+    if stats is None:
+        stats = GEMINI_MODEL_STATS[model_name] = {
+            "calls": 0, "errors": 0, "fallbacks": 0, "latencies": deque(maxlen=200),
+        }
+    return stats
+
+def _latency_line(values):
+    values = sorted(values)
+    if not values:
+        return "—"
+    p50 = values[len(values) // 2]
+    p95 = values[min(int(len(values) * 0.95), len(values) - 1)]
+    return f"p50 {p50:.2f}s, p95 {p95:.2f}s"
+
+def gemini_model_stats_lines():
+    lines = []
+    for name, s in GEMINI_MODEL_STATS.items():
+        latency = _latency_line(s["latencies"])
+        lines.append(f"• {name}: {s['calls']} so'rov, xato {s['errors']}, zaxiraga o'tish {s['fallbacks']} | {latency}")
+    return lines
+
+async def gemini_generate(purpose, contents, generation_config):
+    """Maqsad bo'yicha modellar zanjiri orqali so'rov yuboradi: model xato bersa yoki barcha kalitlarda
+    kvota tugasa keyingi modelga o'tiladi. Mahalliy byudjet tugasa (GeminiBudgetExceeded) o'tilmaydi."""
+    tiers = GEMINI_MODEL_TIERS.get(purpose) or ["gemini-2.0-flash"]
+    for i, model_name in enumerate(tiers):
+        stats = _gemini_model_stats(model_name)
+        if i + 1 < len(tiers) and not GEMINI_KEYS.model_available(model_name):
+            # Barcha kalitlarda bu model uchun kvota tugagan — kutmasdan keyingisiga o'tamiz
+            stats["fallbacks"] += 1
+            continue
+        stats["calls"] += 1
+        started = time.monotonic()
+        try:
+            response = await _gemini_call(purpose, model_name, contents, generation_config)
+        except (GeminiBudgetExceeded, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            stats["errors"] += 1
+            if i + 1 >= len(tiers):
+                raise
+            stats["fallbacks"] += 1
+            logger.warning(f"[GEMINI ROUTE] {purpose}: {model_name} xato ({e.__class__.__name__}), {tiers[i + 1]} ga o'tiladi")
+            continue
+        stats["latencies"].append(time.monotonic() - started)
+        return response
+
+async def _gemini_call(purpose, model_name, contents, generation_config):
+    """Kalitlar pulidan foydalanib Gemini'ga so'rov yuboradi. 429 bo'lsa boshqa kalit bilan qayta urinadi."""
+    tokens = _estimate_tokens(contents, generation_config.max_output_tokens or 0)
+    tried = []
+    while True:
+        key, entry = await GEMINI_KEYS.acquire(purpose, tokens, model_name, exclude=tried)
+        model = _gemini_model(model_name, key)
+        try:
+            response = await model.generate_content_async(contents, generation_config=generation_config)
+        except google_exceptions.ResourceExhausted:
+            GEMINI_KEYS.record(key, entry, model_name, rate_limited=True, ok=False)
+            tried.append(key)
+            if len(tried) >= len(GEMINI_KEYS.keys):
+                raise
+            continue
+        except Exception:
+            GEMINI_KEYS.record(key, entry, model_name, ok=False)
+            raise
+        usage = getattr(response, "usage_metadata", None)
+        GEMINI_KEYS.record(key, entry, model_name, tokens_used=getattr(usage, "total_token_count", None) or None)
+        return response
+
+async def gemini_stream(purpose, contents, generation_config):
+    """gemini_generate ning oqimli varianti: matn bo'laklarini kelishi bilan qaytaradi.
+    Keyingi modelga faqat birinchi bo'lak kelmasdan oldin o'tiladi."""
+    tiers = GEMINI_MODEL_TIERS.get(purpose) or ["gemini-2.0-flash"]
+    for i, model_name in enumerate(tiers):
+        stats = _gemini_model_stats(model_name)
+        if i + 1 < len(tiers) and not GEMINI_KEYS.model_available(model_name):
+            stats["fallbacks"] += 1
+            continue
+        stats["calls"] += 1
+        started = time.monotonic()
+        yielded = False
+        try:
+            async for text in _gemini_stream_call(purpose, model_name, contents, generation_config):
+                yielded = True
+                yield text
+        except (GeminiBudgetExceeded, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            stats["errors"] += 1
+            if yielded or i + 1 >= len(tiers):
+                raise
+            stats["fallbacks"] += 1
+            logger.warning(f"[GEMINI ROUTE] {purpose}: {model_name} xato ({e.__class__.__name__}), {tiers[i + 1]} ga o'tiladi")
+            continue
+        stats["latencies"].append(time.monotonic() - started)
+        return
+
+async def _gemini_stream_call(purpose, model_name, contents, generation_config):
+    tokens = _estimate_tokens(contents, generation_config.max_output_tokens or 0)
+    tried = []
+    while True:
+        key, entry = await GEMINI_KEYS.acquire(purpose, tokens, model_name, exclude=tried)
+        model = _gemini_model(model_name, key)
+        usage = None
+        yielded = False
+        try:
+            response = await model.generate_content_async(contents, generation_config=generation_config, stream=True)
+            async for chunk in response:
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Matnsiz bo'lak (masalan, faqat finish_reason)
+                    text = ""
+                if text:
+                    yielded = True
+                    yield text
+        except google_exceptions.ResourceExhausted:
+            GEMINI_KEYS.record(key, entry, model_name, rate_limited=True, ok=False)
+            tried.append(key)
+            if yielded or len(tried) >= len(GEMINI_KEYS.keys):
+                raise
+            continue
+        except (GeneratorExit, asyncio.CancelledError):
+            # Iste'molchi oqimni erta yopdi yoki navbat so'rovni bekor qildi — kalit aybdor emas
+            GEMINI_KEYS.record(key, entry, model_name, ok=None)
+            raise
+        except Exception:
+            GEMINI_KEYS.record(key, entry, model_name, ok=False)
+            raise
+        GEMINI_KEYS.record(key, entry, model_name, tokens_used=getattr(usage, "total_token_count", None) or None)
+        return
+
+# ---------------- Prompt tarjimasi ----------------
+GEMINI_TRANSLATE_INSTRUCTION = "Automatically detect the user’s language and translate it into English. Convert the text into a professional, detailed image-generation prompt with realistic, cinematic, and descriptive style. Focus on atmosphere, lighting, color, and composition. Return only the final English prompt. Do not include any explanations or extra text :"
+GEMINI_REFUSAL_PHRASES = [
+    "i cannot",
+    "sorry",
+    "i'm sorry",
+    "i am sorry",
+    "i am programmed",
+    "harmless ai",
+    "not allowed",
+    "unable to",
+    "can't assist",
+    "not appropriate",
+    "refuse to",
+    "against my guidelines",
+    "i don't",
+    "i won't",
+    "i do not"
+]
+# Inglizcha promptlar uchun qisqa, faqat boyitish buyrug'i
+GEMINI_ENHANCE_INSTRUCTION = "Rewrite this English text as a professional, detailed image-generation prompt with realistic, cinematic, and descriptive style. Return only the final prompt :"
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "5000"))
+# Allaqachon inglizcha promptlar: skip — Gemini chaqirilmaydi, enhance — qisqa boyitish buyrug'i, off — hammasi tarjimaga
+ENGLISH_PROMPT_MODE = os.getenv("ENGLISH_PROMPT_MODE", "enhance").lower()
+# generate_cb tarjimani shuncha soniya kutadi, keyin asl prompt bilan davom etadi
+PROMPT_TRANSLATE_DEADLINE = float(os.getenv("PROMPT_TRANSLATE_DEADLINE", "4"))
+PROMPT_STATS = {
+    "mem_hits": 0, "db_hits": 0, "misses": 0, "refused": 0, "errors": 0,
+    "superseded": 0, "late": 0,
+    "english": 0, "english_skipped": 0, "english_enhanced": 0, "other_lang": 0,
+}
+# prompt_hash -> (translated, refused)
+_PROMPT_CACHE = OrderedDict()
+
+def normalize_prompt(text):
+    """Bir xil ma'noli promptlar bitta kalitga tushishi uchun: NFKC, kichik harf, bitta probel."""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return " ".join(text.split()).strip(" .!?,;")
+
+def prompt_hash(text, kind="translate"):
+    normalized = normalize_prompt(text)
+    if kind != "translate":
+        normalized = f"{kind}\n{normalized}"
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+# ---------------- Mahalliy til aniqlash ----------------
+# Gemini'ga bormasdan oldin prompt allaqachon inglizcha ekanini taxmin qiladi:
+# 1) yozuv: lotin bo'lmagan yoki diakritikali harflar bo'lsa — inglizcha emas;
+# 2) so'zlar: inglizcha va botdagi boshqa lotin tillaridagi (uz, id, lt, es, it, pt) tez-tez so'zlar;
+# 3) harf trigrammalari: inglizchada eng ko'p uchraydigan trigrammalar ulushi.
+EN_WORDS = frozenset("""
+a an the of and or with without in on at by for from to into over under near behind between
+is are was be this that these those it its his her their my your our
+very more most high ultra super best new old big small tall long short beautiful cute dark light bright
+man woman men women girl boy child kid baby people person lady guy couple family friend warrior king queen
+cat dog horse bird lion tiger wolf dragon fox bear fish car city street house room forest mountain sea ocean
+beach river lake sky sun moon star night day morning sunset sunrise rain snow fire water tree flower garden
+portrait photo photography realistic cinematic anime style art painting drawing illustration render
+detailed detail quality resolution lighting light background color colors colorful black white red blue
+green yellow pink purple gold golden silver hair eyes face smile dress suit wearing holding standing sitting
+walking running flying looking cyberpunk futuristic fantasy space neon vintage modern castle wedding
+""".split())
+OTHER_LATIN_WORDS = frozenset("""
+va bilan uchun bir rasm qiz yigit bola chiroyli katta kichik ayol erkak mashina shahar tun kun osmon
+dan yang dengan di ke dari seorang gadis anak laki perempuan cantik kucing mobil kota malam langit
+ir su mergina vaikinas graži katinas miestas naktis dangus
+el la los las de del con y una un en por para muy chica chico hermosa gato ciudad noche cielo
+il lo gli di della con e nel una ragazza ragazzo bella gatto citta notte cielo
+o os da do das dos com em uma um menina menino bonita gato cidade noite ceu
+""".split())
+EN_TRIGRAMS = frozenset("""
+the ing and ion tio ent ati her for ter hat tha ere ate his con res ver all ons nce men ith ted ers
+pro thi wit are ess not ive was ect rea com eve per int est sta cti ica ist ear ain one our iti rat
+igh ght ful eau aut lig ati ort rai ait oto ure ound wea hai air ark ome tre eet ree
+""".split())
+ENGLISH_MIN_SCORE = float(os.getenv("ENGLISH_MIN_SCORE", "0.6"))
+_WORD_RE = re.compile(r"[a-z]+(?:'[a-z]+)?")
+
+def detect_english(text):
+    """(inglizchami, ball) qaytaradi. Shubhali holatlarda False — tarjima xavfsizroq."""
+    letters = [ch for ch in text if ch.isalpha()]
+    if not letters:
+        return False, 0.0
+    # Faqat ASCII lotin harflari — boshqa yozuv yoki diakritika bo'lsa inglizcha emas
+    if any(not ("a" <= ch.lower() <= "z") for ch in letters):
+        return False, 0.0
+    words = _WORD_RE.findall(text.lower())
+    if not words:
+        return False, 0.0
+    if any(w in OTHER_LATIN_WORDS and w not in EN_WORDS for w in words):
+        return False, 0.0
+    word_score = sum(w in EN_WORDS or (w.endswith("s") and w[:-1] in EN_WORDS) for w in words) / len(words)
+    trigrams = [w[i:i + 3] for w in words for i in range(len(w) - 2)]
+    # Inglizcha matnda mashhur trigrammalar odatda ~30% ni tashkil qiladi
+    tri_score = min(sum(t in EN_TRIGRAMS for t in trigrams) / len(trigrams) / 0.3, 1.0) if trigrams else word_score
+    score = 0.7 * word_score + 0.3 * tri_score
+    return score >= ENGLISH_MIN_SCORE, score
+
+# ---------------- Ibora moslashtirgich ----------------
+# Rad etish iboralari va taqiqlangan so'zlar har biri o'z kompilyatsiya qilingan regexida: kategoriyalar
+# alohida o'tiladi, shuning uchun rad etish iborasi taqiqlangan so'zni "yutib" yubormaydi.
+# PROMPT_BLOCKLIST: {"*": ["..."], "uz": ["..."], "en": ["..."]} — "*" barcha tillar uchun.
+PROMPT_BLOCKLIST = json.loads(os.getenv("PROMPT_BLOCKLIST", "{}"))
+
+def _trie_pattern(words):
+    """So'zlardan prefiks daraxti bo'yicha regex quradi: umumiy boshlanishlar bir marta tekshiriladi,
+    uzunroq davom har doim qisqaroq tugashdan oldin sinaladi."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node):
+        end = "" in node
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if end:
+            return "(?:" + body + ")?"
+        return body
+
+    return build(trie)
+
+class PhraseMatcher:
+    def __init__(self, refusals, blocklists):
+        # ibora -> [(kategoriya, til), ...]
+        self._meta = {}
+        substrings, words = set(), set()
+        for phrase in refusals:
+            phrase = phrase.casefold()
+            self._meta.setdefault(phrase, []).append(("refusal", "*"))
+            # Rad etish iboralari eski tekshiruvdagidek matn ichida qidiriladi
+            substrings.add(phrase)
+        for lang_code, terms in (blocklists or {}).items():
+            for term in terms:
+                term = term.casefold().strip()
+                if not term:
+                    continue
+                self._meta.setdefault(term, []).append(("block", lang_code))
+                words.add(term)
+        self._regexes = {}
+        if substrings:
+            self._regexes["refusal"] = re.compile(_trie_pattern(substrings))
+        if words:
+            # Taqiqlangan so'zlar butun so'z sifatida
+            self._regexes["block"] = re.compile(rf"(?<!\w){_trie_pattern(words)}(?!\w)")
+        self.matches = {}
+
+    def scan(self, text, lang_code=None, categories=None):
+        """Berilgan kategoriyalar (standart — hammasi) bo'yicha {kategoriya: [iboralar]} qaytaradi."""
+        found = {}
+        if not text:
+            return found
+        folded = text.casefold()
+        for category in categories or self._regexes:
+            regex = self._regexes.get(category)
+            if regex is None:
+                continue
+            for m in regex.finditer(folded):
+                phrase = m.group(0)
+                for meta_category, lang in self._meta.get(phrase, ()):
+                    if meta_category != category or (lang != "*" and lang != lang_code):
+                        continue
+                    found.setdefault(category, []).append(phrase)
+                    key = (category, phrase)
+                    self.matches[key] = self.matches.get(key, 0) + 1
+        return found
+
+    def stats_line(self, limit=5):
+        top = sorted(self.matches.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+        return ", ".join(f"{cat}:{phrase}×{n}" for (cat, phrase), n in top) or "—"
+
+PROMPT_MATCHER = PhraseMatcher(GEMINI_REFUSAL_PHRASES, PROMPT_BLOCKLIST)
+
+def is_refusal(text):
+    return not text or "refusal" in PROMPT_MATCHER.scan(text, categories=("refusal",))
+
+def prompt_blocked(prompt, translated, lang_code):
+    """Foydalanuvchi tilidagi asl prompt va inglizcha tarjimani taqiqlangan so'zlarga tekshiradi."""
+    if "block" in PROMPT_MATCHER.scan(prompt, lang_code, categories=("block",)):
+        return True
+    return (
+        bool(translated) and translated != prompt
+        and "block" in PROMPT_MATCHER.scan(translated, "en", categories=("block",))
+    )
+
+def _prompt_cache_put(key, translated, refused):
+    _PROMPT_CACHE[key] = (translated, refused)
+    _PROMPT_CACHE.move_to_end(key)
+    while len(_PROMPT_CACHE) > PROMPT_CACHE_SIZE:
+        _PROMPT_CACHE.popitem(last=False)
+
+async def _gemini_translate(prompt, instruction=GEMINI_TRANSLATE_INSTRUCTION):
+    response = await gemini_generate(
+        "translate",
+        f"{instruction}\n{prompt}",
+        generation_config=genai.types.GenerationConfig(
+            max_output_tokens=100,
+            temperature=0.5
+        )
+    )
+    return response.text.strip()
+
+# ---------------- Gemini micro-batching ----------------
+# Bir vaqtda kelgan tarjimalar bir necha ms yig'iladi va bitta so'rovda JSON massiv sifatida yuboriladi.
+GEMINI_BATCH_WINDOW_MS = int(os.getenv("GEMINI_BATCH_WINDOW_MS", "20"))
+GEMINI_BATCH_MAX = int(os.getenv("GEMINI_BATCH_MAX", "16"))
+
+class GeminiBatcher:
+    def __init__(self, window_ms, max_size):
+        self.window = max(window_ms, 0) / 1000
+        self.max_size = max(int(max_size), 1)
+        # instruction -> [(prompt, future), ...]
+        self._pending = {}
+        self._timers = {}
+        # Yuborilgan guruhlar (task -> [(prompt, future), ...]) — stop() ularni bekor qiladi
+        self._tasks = {}
+        self.stats = {"calls": 0, "batched_items": 0, "max_batch": 0, "fallbacks": 0}
+
+    async def submit(self, prompt, instruction):
+        if self.max_size == 1 or self.window == 0:
+            self.stats["calls"] += 1
+            return await _gemini_translate(prompt, instruction)
+        fut = asyncio.get_running_loop().create_future()
+        batch = self._pending.setdefault(instruction, [])
+        batch.append((prompt, fut))
+        if len(batch) >= self.max_size:
+            self._flush(instruction)
+        elif instruction not in self._timers:
+            self._timers[instruction] = asyncio.get_running_loop().call_later(
+                self.window, self._flush, instruction
+            )
+        return await fut
+
+    def _flush(self, instruction):
+        timer = self._timers.pop(instruction, None)
+        if timer:
+            timer.cancel()
+        batch = [(p, f) for p, f in self._pending.pop(instruction, []) if not f.done()]
+        if batch:
+            task = asyncio.create_task(self._run(instruction, batch))
+            self._tasks[task] = batch
+            task.add_done_callback(lambda t: self._tasks.pop(t, None))
+
+    async def stop(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        tasks = dict(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Navbatdagi va bekor qilingan guruhlardagi kutayotganlar ham bo'shatiladi
+        batches = itertools.chain(self._pending.values(), tasks.values())
+        for _, fut in itertools.chain.from_iterable(batches):
+            if not fut.done():
+                fut.cancel()
+        self._pending.clear()
+
+    async def _run(self, instruction, batch):
+        self.stats["calls"] += 1
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        if len(batch) == 1:
+            prompt, fut = batch[0]
+            await self._resolve_single(prompt, instruction, fut)
+            return
+        self.stats["batched_items"] += len(batch)
+        results = None
+        try:
+            results = await _gemini_translate_batch([p for p, _ in batch], instruction)
+        except Exception as e:
+            logger.warning(f"[GEMINI BATCH] {len(batch)} ta prompt: {e}")
+        if results is None:
+            # Javobni ajratib bo'lmadi — har bir promptni alohida yuboramiz
+            self.stats["fallbacks"] += 1
+            await asyncio.gather(*(self._resolve_single(p, instruction, f) for p, f in batch))
+            return
+        retry = []
+        for (prompt, fut), text in zip(batch, results):
+            if text is None:
+                retry.append((prompt, fut))
+            elif not fut.done():
+                fut.set_result(text)
+        if retry:
+            self.stats["fallbacks"] += 1
+            await asyncio.gather(*(self._resolve_single(p, instruction, f) for p, f in retry))
+
+    async def _resolve_single(self, prompt, instruction, fut):
+        if fut.done():
+            return
+        try:
+            result = await _gemini_translate(prompt, instruction)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+            return
+        if not fut.done():
+            fut.set_result(result)
+
+GEMINI_BATCHER = GeminiBatcher(GEMINI_BATCH_WINDOW_MS, GEMINI_BATCH_MAX)
+
+async def _gemini_translate_batch(prompts, instruction):
+    """Bir nechta promptni bitta so'rovda yuboradi. Javob uzunligi mos JSON massiv bo'lmasa None."""
+    batch_prompt = (
+        f"{instruction.rstrip(' :')}. Apply this independently to every item of the JSON array below. "
+        "Respond only with a JSON array of strings, with the same length and order as the input.\n"
+        f"{json.dumps(prompts, ensure_ascii=False)}"
+    )
+    response = await gemini_generate(
+        "translate",
+        batch_prompt,
+        generation_config=genai.types.GenerationConfig(
+            max_output_tokens=100 * len(prompts),
+            temperature=0.5,
+            response_mime_type="application/json"
+        )
+    )
+    try:
+        data = json.loads(response.text)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(data, list) or len(data) != len(prompts):
+        return None
+    # Bo'sh yoki satr bo'lmagan elementlar alohida qayta so'raladi
+    return [item.strip() if isinstance(item, str) and item.strip() else None for item in data]
+
+async def translate_prompt(pool, prompt):
+    """Promptni Digen uchun inglizchaga o'giradi. Avval xotira, keyin prompt_translations jadvali
+    tekshiriladi; Gemini faqat yangi promptlar uchun chaqiriladi. Rad etilsa yoki xato bo'lsa
+    asl matn qaytadi. Inglizcha promptlar ENGLISH_PROMPT_MODE bo'yicha o'tkazib yuboriladi yoki
+    faqat boyitiladi."""
+    kind, instruction = "translate", GEMINI_TRANSLATE_INSTRUCTION
+    if ENGLISH_PROMPT_MODE in ("skip", "enhance"):
+        english, _ = detect_english(prompt)
+        if english:
+            PROMPT_STATS["english"] += 1
+            if ENGLISH_PROMPT_MODE == "skip":
+                PROMPT_STATS["english_skipped"] += 1
+                return prompt
+            kind, instruction = "enhance", GEMINI_ENHANCE_INSTRUCTION
+        else:
+            PROMPT_STATS["other_lang"] += 1
+    key = prompt_hash(prompt, kind)
+    cached = _PROMPT_CACHE.get(key)
+    if cached:
+        _PROMPT_CACHE.move_to_end(key)
+        PROMPT_STATS["mem_hits"] += 1
+        translated, refused = cached
+        return prompt if refused else translated
+
+    try:
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "UPDATE prompt_translations SET hits = hits + 1, last_hit_at = now() "
+                "WHERE prompt_hash = $1 RETURNING translated, refused",
+                key
+            )
+    except Exception as e:
+        logger.warning(f"[PROMPT CACHE] DB o'qish xatosi: {e}")
+        row = None
+    if row:
+        PROMPT_STATS["db_hits"] += 1
+        _prompt_cache_put(key, row["translated"], row["refused"])
+        return prompt if row["refused"] else row["translated"]
+
+    PROMPT_STATS["misses"] += 1
+    if kind == "enhance":
+        PROMPT_STATS["english_enhanced"] += 1
+    try:
+        translated = await GEMINI_BATCHER.submit(prompt, instruction)
+    except Exception as gemini_err:
+        # Xatolar keshlanmaydi — keyingi safar yana urinib ko'riladi
+        PROMPT_STATS["errors"] += 1
+        logger.error(f"[GEMINI PROMPT ERROR] {gemini_err}")
+        return prompt
+
+    refused = is_refusal(translated)
+    if refused:
+        PROMPT_STATS["refused"] += 1
+        logger.warning(f"[GEMINI FILTERED] Prompt rad etildi: '{prompt}' → '{translated}'. Asl matn saqlanadi.")
+        translated = None
+    _prompt_cache_put(key, translated, refused)
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO prompt_translations(prompt_hash, prompt, translated, refused) "
+                "VALUES($1, $2, $3, $4) ON CONFLICT (prompt_hash) DO NOTHING",
+                key, prompt, translated, refused
+            )
+    except Exception as e:
+        logger.warning(f"[PROMPT CACHE] DB yozish xatosi: {e}")
+    return prompt if refused else translated
+
+def start_prompt_translation(context, prompt):
+    """Tarjimani foydalanuvchi uchun fon vazifasi sifatida boshlaydi. Yangi prompt kelsa,
+    avvalgisining tarjimasi endi kerak emas — bekor qilinadi."""
+    old = context.user_data.pop("translation_task", None)
+    if old and not old.done():
+        old.cancel()
+        PROMPT_STATS["superseded"] += 1
+    context.user_data["translated"] = prompt
+    context.user_data["translation_task"] = asyncio.create_task(
+        translate_prompt(context.application.bot_data["db_pool"], prompt)
+    )
+
+async def await_prompt_translation(context, prompt):
+    """Fondagi tarjimani PROMPT_TRANSLATE_DEADLINE gacha kutadi. Ulgurmasa asl prompt qaytadi,
+    vazifa esa to'xtatilmaydi — natija keshga tushadi."""
+    task = context.user_data.get("translation_task")
+    if task is None:
+        return context.user_data.get("translated", prompt)
+    try:
+        translated = await asyncio.wait_for(asyncio.shield(task), PROMPT_TRANSLATE_DEADLINE)
+    except asyncio.TimeoutError:
+        PROMPT_STATS["late"] += 1
+        logger.warning(f"[PROMPT TRANSLATE] {PROMPT_TRANSLATE_DEADLINE}s da ulgurmadi, asl prompt ishlatiladi")
+        return prompt
+    except asyncio.CancelledError:
+        if task.cancelled():
+            return prompt
+        raise
+    context.user_data["translated"] = translated
+    return translated
+
+def prompt_cache_stats_line():
+    s = PROMPT_STATS
+    total = s["mem_hits"] + s["db_hits"] + s["misses"]
+    hit_rate = (s["mem_hits"] + s["db_hits"]) / total if total else 0.0
+    return (
+        f"{len(_PROMPT_CACHE)} ta | xotira {s['mem_hits']}, DB {s['db_hits']}, miss {s['misses']} "
+        f"({hit_rate:.0%} hit), rad {s['refused']}, xato {s['errors']}, "
+        f"bekor {s['superseded']}, kechikkan {s['late']}\n"
+        f"📦 *Gemini batch:* {GEMINI_BATCHER.stats['calls']} so'rov, "
+        f"{GEMINI_BATCHER.stats['batched_items']} prompt guruhda, max {GEMINI_BATCHER.stats['max_batch']}, "
+        f"fallback {GEMINI_BATCHER.stats['fallbacks']}\n"
+        f"🛑 *Iboralar:* {PROMPT_MATCHER.stats_line()}\n"
+        f"🔤 *Til aniqlash ({ENGLISH_PROMPT_MODE}):* inglizcha {s['english']} "
+        f"(o'tkazildi {s['english_skipped']}, boyitildi {s['english_enhanced']}), boshqa {s['other_lang']}"
+    )
+
 # Private plain text -> prompt + inline buttons yoki AI chat
 # Yangilangan: Tanlov tugmachasi bosilganda flow o'rnatiladi
-# Private plain text -> prompt + inline buttons yoki AI chat
-# Yangilangan: Tanlov tugmachasi bosilganda flow o'rnatiladi
+# ---------------- AI chat xotirasi ----------------
+# Suhbat shuncha soniya harakatsizlikdan keyin tugaydi — xotira ham birga o'chadi
+AI_CHAT_IDLE_SECONDS = int(os.getenv("AI_CHAT_IDLE_SECONDS", "900"))
+# Oxirgi xabarlar uchun token byudjeti; oshsa eski qism fonda xulosaga aylantiriladi
+AI_MEMORY_TOKEN_BUDGET = int(os.getenv("AI_MEMORY_TOKEN_BUDGET", "1500"))
+AI_MEMORY_MAX_TURNS = int(os.getenv("AI_MEMORY_MAX_TURNS", "12"))
+# Xotirada saqlanadigan foydalanuvchilar soni (LRU) — RSS chegaralangan bo'lishi uchun
+AI_MEMORY_MAX_USERS = int(os.getenv("AI_MEMORY_MAX_USERS", "10000"))
+AI_MEMORY_TURN_CHARS = int(os.getenv("AI_MEMORY_TURN_CHARS", "2000"))
+AI_MEMORY_SUMMARY_CHARS = int(os.getenv("AI_MEMORY_SUMMARY_CHARS", "1200"))
+AI_SUMMARY_INSTRUCTION = "Summarize this conversation between a user and an assistant in under 120 words. Keep names, facts, preferences and open questions, in the user's language. Return only the summary :"
+
+def _text_tokens(text):
+    return len(text) // 4 + 1
+
+def _format_turns(turns):
+    return "\n".join(f"User: {user_text}\nAssistant: {model_text}" for user_text, model_text, _ in turns)
+
+class ChatHistory:
+    __slots__ = ("summary", "turns", "folding", "tokens", "last_used", "summarizing")
+
+    def __init__(self):
+        self.summary = ""
+        # (foydalanuvchi matni, javob, token) — eng eskisi chapda
+        self.turns = deque()
+        # Xulosa tayyor bo'lguncha promptda qoladigan eski turnlar
+        self.folding = ()
+        self.tokens = 0
+        self.last_used = time.monotonic()
+        self.summarizing = None
+
+class ChatMemory:
+    """Har bir foydalanuvchi uchun oxirgi suhbat turnlari. Token byudjeti oshsa eski yarmi fonda
+    Gemini orqali xulosaga aylantiriladi; AI_CHAT_IDLE_SECONDS harakatsizlikdan keyin o'chadi."""
+
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self._data = OrderedDict()
+        self.stats = {"evicted": 0, "expired": 0, "summaries": 0, "summary_errors": 0, "dropped_turns": 0}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, user_id):
+        hist = self._data.get(user_id)
+        if hist is None:
+            return None
+        if time.monotonic() - hist.last_used > AI_CHAT_IDLE_SECONDS:
+            self.stats["expired"] += 1
+            self.drop(user_id)
+            return None
+        self._data.move_to_end(user_id)
+        return hist
+
+    def drop(self, user_id):
+        hist = self._data.pop(user_id, None)
+        if hist and hist.summarizing and not hist.summarizing.done():
+            hist.summarizing.cancel()
+
+    def build_prompt(self, user_id, prompt):
+        hist = self.get(user_id)
+        if hist is None or not (hist.summary or hist.folding or hist.turns):
+            return prompt
+        parts = []
+        if hist.summary:
+            parts.append(f"Summary of the earlier conversation: {hist.summary}")
+        if hist.folding or hist.turns:
+            parts.append(_format_turns((*hist.folding, *hist.turns)))
+        return "Conversation so far:\n" + "\n".join(parts) + f"\n\nReply to the user's new message:\n{prompt}"
+
+    def add(self, user_id, prompt, answer):
+        hist = self.get(user_id)
+        if hist is None:
+            hist = self._data[user_id] = ChatHistory()
+            while len(self._data) > self.max_users:
+                _, old = self._data.popitem(last=False)
+                if old.summarizing and not old.summarizing.done():
+                    old.summarizing.cancel()
+                self.stats["evicted"] += 1
+        prompt = prompt[:AI_MEMORY_TURN_CHARS]
+        answer = answer[:AI_MEMORY_TURN_CHARS]
+        tokens = _text_tokens(prompt) + _text_tokens(answer)
+        hist.turns.append((prompt, answer, tokens))
+        hist.tokens += tokens
+        hist.last_used = time.monotonic()
+
+        over = hist.tokens + _text_tokens(hist.summary) > AI_MEMORY_TOKEN_BUDGET or len(hist.turns) > AI_MEMORY_MAX_TURNS
+        if over and hist.summarizing is None and len(hist.turns) > 1:
+            # Eski turnlar byudjet yarmiga tushguncha ajratiladi, eng oxirgisi doim qoladi
+            old = []
+            while len(hist.turns) > 1 and (not old or hist.tokens > AI_MEMORY_TOKEN_BUDGET // 2):
+                turn = hist.turns.popleft()
+                hist.tokens -= turn[2]
+                old.append(turn)
+            hist.folding = tuple(old)
+            hist.summarizing = asyncio.create_task(self._summarize(hist, old))
+        # Xulosa kutilayotganda ham xotira cheksiz o'smasin
+        while len(hist.turns) > 1 and (hist.tokens > 2 * AI_MEMORY_TOKEN_BUDGET or len(hist.turns) > 2 * AI_MEMORY_MAX_TURNS):
+            hist.tokens -= hist.turns.popleft()[2]
+            self.stats["dropped_turns"] += 1
+
+    async def _summarize(self, hist, old):
+        text = (f"Earlier summary: {hist.summary}\n" if hist.summary else "") + _format_turns(old)
+        summary = ""
+        try:
+            response = await gemini_generate(
+                "summary",
+                f"{AI_SUMMARY_INSTRUCTION}\n{text}",
+                generation_config=genai.types.GenerationConfig(
+                    max_output_tokens=250,
+                    temperature=0.2
+                )
+            )
+            summary = response.text.strip()[:AI_MEMORY_SUMMARY_CHARS]
+            self.stats["summaries"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats["summary_errors"] += 1
+            logger.warning(f"[AI MEMORY] xulosa xatosi: {e}")
+        finally:
+            hist.summarizing = None
+        # Xulosa bo'lmasa — eski matnning oxirgi qismi saqlanadi
+        hist.summary = summary or text[-AI_MEMORY_SUMMARY_CHARS:]
+        hist.folding = ()
+
+    async def stop(self):
+        tasks = [h.summarizing for h in self._data.values() if h.summarizing and not h.summarizing.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats_line(self):
+        s = self.stats
+        tokens = sum(h.tokens + _text_tokens(h.summary) for h in self._data.values())
+        return (
+            f"{len(self._data)}/{self.max_users} foydalanuvchi, ~{tokens // 1000}k token | "
+            f"xulosa {s['summaries']} (xato {s['summary_errors']}), "
+            f"LRU {s['evicted']}, muddati o'tgan {s['expired']}, tashlangan {s['dropped_turns']}"
+        )
+
+AI_CHAT_MEMORY = ChatMemory(AI_MEMORY_MAX_USERS)
+
+# ---------------- AI chat (oqimli javob) ----------------
+# Bitta xabarni tahrirlash oralig'i — Telegram bitta chatda ~1 xabar/s dan ko'pini yoqtirmaydi
+AI_STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL", "1.2"))
+TELEGRAM_TEXT_LIMIT = 4096
+AI_CHAT_STATS = {
+    "replies": 0, "errors": 0, "edits": 0, "edit_skips": 0, "parts": 0,
+    "ttft": deque(maxlen=200), "total": deque(maxlen=200),
+}
+
+def _split_reply(text, limit=TELEGRAM_TEXT_LIMIT):
+    """Limitdan oshgan matnning boshini qator/so'z chegarasida ajratadi: (bosh, qolgan)."""
+    if len(text) <= limit:
+        return text, ""
+    cut = text.rfind("\n", limit // 2, limit)
+    if cut < 0:
+        cut = text.rfind(" ", limit // 2, limit)
+    if cut < 0:
+        cut = limit
+    return text[:cut], text[cut:].lstrip()
+
+async def _edit_stream_message(message, text, wait=False):
+    """Oraliq tahrirda RetryAfter bo'lsa o'tkazib yuboriladi; wait=True da (yakuniy matn) kutib qayta uriniladi."""
+    for _ in range(3):
+        try:
+            await message.edit_text(text)
+            AI_CHAT_STATS["edits"] += 1
+            return True
+        except BadRequest as e:
+            if "message is not modified" in str(e):
+                return True
+            raise
+        except telegram.error.RetryAfter as e:
+            AI_CHAT_STATS["edit_skips"] += 1
+            if not wait:
+                return False
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            await asyncio.sleep(retry_after)
+    return False
+
+async def ai_chat_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, lang, prompt, turn=None):
+    """Gemini javobini oqim sifatida bitta xabarga yozib boradi; 4096 belgidan oshsa yangi xabarga o'tadi."""
+    received = time.monotonic()
+    user_id = update.effective_user.id
+    header = lang["ai_response_header"]
+    if turn is not None and turn.message is not None:
+        message = turn.message
+    else:
+        message = await update.message.reply_text("🧠 AI javob bermoqda...")
+    # Joriy xabarga tegishli matn (birinchi xabarda sarlavha bilan)
+    current = f"{header}\n"
+    shown = ""
+    last_edit = 0.0
+    got_text = False
+    answer = ""
+    stream = gemini_stream(
+        "chat",
+        AI_CHAT_MEMORY.build_prompt(user_id, prompt),
+        generation_config=genai.types.GenerationConfig(
+            max_output_tokens=1000,
+            temperature=0.7
+        )
+    )
+    try:
+        async with aclosing(stream):
+            async for chunk in stream:
+                if not got_text:
+                    got_text = True
+                    if turn is not None:
+                        turn.streaming = True
+                    AI_CHAT_STATS["ttft"].append(time.monotonic() - received)
+                current += chunk
+                answer += chunk
+                while len(current) > TELEGRAM_TEXT_LIMIT:
+                    head, current = _split_reply(current)
+                    await _edit_stream_message(message, head, wait=True)
+                    shown = current[:TELEGRAM_TEXT_LIMIT] or "…"
+                    message = await update.message.reply_text(shown)
+                    AI_CHAT_STATS["parts"] += 1
+                    last_edit = time.monotonic()
+                if current != shown and time.monotonic() - last_edit >= AI_STREAM_EDIT_INTERVAL:
+                    if await _edit_stream_message(message, current):
+                        shown = current
+                    last_edit = time.monotonic()
+        if got_text:
+            AI_CHAT_MEMORY.add(user_id, prompt, answer.strip())
+        else:
+            current = f"{header}\n⚠️ Javob topilmadi."
+        AI_CHAT_STATS["replies"] += 1
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("[GEMINI ERROR]")
+        AI_CHAT_STATS["errors"] += 1
+        # Qisman javob bo'lsa saqlanadi, bo'lmasa xato matni
+        current = current + "\n\n⚠️" if got_text else lang["error"]
+    AI_CHAT_STATS["total"].append(time.monotonic() - received)
+    if current != shown:
+        try:
+            await _edit_stream_message(message, current.strip(), wait=True)
+        except TelegramError:
+            logger.exception("[AI STREAM] yakuniy tahrir xatosi")
+
+def ai_chat_stats_line():
+    s = AI_CHAT_STATS
+    return (
+        f"{s['replies']} javob, xato {s['errors']} | TTFT {_latency_line(s['ttft'])} | "
+        f"to'liq {_latency_line(s['total'])} | tahrir {s['edits']} (o'tkazilgan {s['edit_skips']}), "
+        f"qo'shimcha xabar {s['parts']}"
+    )
+
+class AiChatTurn:
+    __slots__ = ("update", "lang", "prompts", "message", "task", "streaming", "superseded")
+
+    def __init__(self, update, lang):
+        self.update = update
+        self.lang = lang
+        self.prompts = []
+        self.message = None
+        self.task = None
+        self.streaming = False
+        self.superseded = False
+
+class AiChatInflight:
+    """Har bir foydalanuvchi uchun bir vaqtda bitta Gemini chat chaqiruvi.
+    Javob hali boshlanmagan bo'lsa, yangi xabar uni bekor qilib, o'ziga qo'shib oladi; javob oqimda
+    bo'lsa, yangi xabarlar bitta navbatdagi so'rovga yig'iladi. Javoblar xabarlar tartibida chiqadi."""
+
+    def __init__(self):
+        self._workers = {}  # user_id -> worker task
+        self._pending = {}  # user_id -> navbatdagi AiChatTurn
+        self._current = {}  # user_id -> ishlayotgan AiChatTurn
+        self.stats = {"calls": 0, "coalesced": 0, "cancelled": 0, "errors": 0}
+
+    def __len__(self):
+        return len(self._workers)
+
+    def submit(self, user_id, update, context, lang, prompt):
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = self._pending[user_id] = AiChatTurn(update, lang)
+        else:
+            self.stats["coalesced"] += 1
+        pending.update = update
+        pending.lang = lang
+        pending.prompts.append(prompt)
+
+        current = self._current.get(user_id)
+        if current and not current.streaming and not current.superseded:
+            # Javob hali kelmagan — eski so'rovni to'xtatib, xabarlarni bitta so'rovga birlashtiramiz
+            current.superseded = True
+            pending.prompts[:0] = current.prompts
+            self.stats["cancelled"] += 1
+            if current.task:
+                current.task.cancel()
+
+        worker = self._workers.get(user_id)
+        if worker is None or worker.done():
+            self._workers[user_id] = asyncio.create_task(self._run(user_id, context))
+
+    async def _run(self, user_id, context):
+        turn = None
+        try:
+            while True:
+                turn = self._pending.pop(user_id, None)
+                if turn is None:
+                    return
+                self._current[user_id] = turn
+                try:
+                    await self._run_turn(user_id, context, turn)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Worker to'xtamaydi — navbatdagi xabarlar baribir javob oladi
+                    self.stats["errors"] += 1
+                    logger.exception(f"[AI CHAT] user={user_id} navbat xatosi: {e}")
+        except asyncio.CancelledError:
+            if turn and turn.task and not turn.task.done():
+                turn.task.cancel()
+            raise
+        finally:
+            self._current.pop(user_id, None)
+            if self._workers.get(user_id) is asyncio.current_task():
+                self._workers.pop(user_id, None)
+
+    async def _run_turn(self, user_id, context, turn):
+        if turn.message is None:
+            try:
+                turn.message = await turn.update.message.reply_text("🧠 AI javob bermoqda...")
+            except TelegramError as e:
+                # Prompt yo'qolmasin: javob o'zi yangi xabar yuborishga urinadi
+                logger.warning(f"[AI CHAT] user={user_id} kutish xabari yuborilmadi: {e}")
+        if not turn.superseded:
+            self.stats["calls"] += 1
+            turn.task = asyncio.create_task(
+                ai_chat_reply(turn.update, context, turn.lang, "\n".join(turn.prompts), turn)
+            )
+            # wait() ichki vazifani bekor qilinishdan himoya qiladi
+            await asyncio.wait([turn.task])
+            if not turn.task.cancelled() and turn.task.exception():
+                self.stats["errors"] += 1
+                logger.error(f"[AI CHAT] user={user_id} javob xatosi: {turn.task.exception()!r}")
+        if turn.superseded:
+            # "AI javob bermoqda..." xabari birlashtirilgan so'rovga o'tadi
+            nxt = self._pending.get(user_id)
+            if nxt is not None and nxt.message is None:
+                nxt.message = turn.message
+
+    async def stop(self):
+        workers = list(self._workers.values())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def stats_line(self):
+        s = self.stats
+        return (
+            f"{len(self._workers)} faol, {s['calls']} chaqiruv, birlashtirilgan {s['coalesced']}, "
+            f"bekor {s['cancelled']}, xato {s['errors']}"
+        )
+
+AI_CHAT_INFLIGHT = AiChatInflight()
+
 async def private_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
         return
 
-    lang_code = DEFAULT_LANGUAGE
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", update.effective_user.id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], update.effective_user.id)
     lang = get_lang(lang_code)
 
     # Agar foydalanuvchi oldin "AI chat" tugmasini bosgan bo'lsa
@@ -2493,48 +4890,16 @@ async def private_text_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         last_active = context.user_data.get("last_active")
         now = datetime.now(timezone.utc)
         if last_active:
-            if (now - last_active).total_seconds() > 900:
+            if (now - last_active).total_seconds() > AI_CHAT_IDLE_SECONDS:
                 context.user_data["flow"] = None
                 context.user_data["last_active"] = None
+                AI_CHAT_MEMORY.drop(update.effective_user.id)
             else:
-                prompt = update.message.text
-                await update.message.reply_text("🧠 AI javob bermoqda...")
-                try:
-                    model = genai.GenerativeModel("gemini-2.0-flash")
-                    response = await model.generate_content_async(
-                        prompt,
-                        generation_config=genai.types.GenerationConfig(
-                            max_output_tokens=1000,
-                            temperature=0.7
-                        )
-                    )
-                    answer = response.text.strip()
-                    if not answer:
-                        answer = "⚠️ Javob topilmadi."
-                except Exception:
-                    logger.exception("[GEMINI ERROR]")
-                    answer = lang["error"]
-                await update.message.reply_text(f"{lang['ai_response_header']}\n{answer}")
+                AI_CHAT_INFLIGHT.submit(update.effective_user.id, update, context, lang, update.message.text)
                 context.user_data["last_active"] = datetime.now(timezone.utc)
                 return
         else:
-            prompt = update.message.text
-            try:
-                model = genai.GenerativeModel("gemini-2.0-flash")
-                response = await model.generate_content_async(
-                    prompt,
-                    generation_config=genai.types.GenerationConfig(
-                        max_output_tokens=1000,
-                        temperature=0.7
-                    )
-                )
-                answer = response.text.strip()
-                if not answer:
-                    answer = "⚠️ Javob topilmadi."
-            except Exception:
-                logger.exception("[GEMINI ERROR]")
-                answer = lang["error"]
-            await update.message.reply_text(f"{lang['ai_response_header']}\n{answer}")
+            AI_CHAT_INFLIGHT.submit(update.effective_user.id, update, context, lang, update.message.text)
             context.user_data["last_active"] = datetime.now(timezone.utc)
             return
 
@@ -2546,49 +4911,8 @@ async def private_text_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     prompt = update.message.text
     context.user_data["prompt"] = prompt
 
-    # --- Promptni Gemini orqali tarjima qilish ---
-    original_prompt = prompt
-    gemini_instruction = "Automatically detect the user’s language and translate it into English. Convert the text into a professional, detailed image-generation prompt with realistic, cinematic, and descriptive style. Focus on atmosphere, lighting, color, and composition. Return only the final English prompt. Do not include any explanations or extra text :"
-    gemini_full_prompt = f"{gemini_instruction}\n{original_prompt}"
-
-    try:
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        gemini_response = await model.generate_content_async(
-            gemini_full_prompt,
-            generation_config=genai.types.GenerationConfig(
-                max_output_tokens=100,
-                temperature=0.5
-            )
-        )
-        digen_ready_prompt = gemini_response.text.strip()
-
-        # ✅ Mantiqiy rad etishlarni tekshirish
-        if digen_ready_prompt and not any(phrase in digen_ready_prompt.lower() for phrase in [
-            "i cannot",
-            "sorry",
-            "i'm sorry",
-            "i am sorry",
-            "i am programmed",
-            "harmless ai",
-            "not allowed",
-            "unable to",
-            "can't assist",
-            "not appropriate",
-            "refuse to",
-            "against my guidelines",
-            "i don't",
-            "i won't",
-            "i do not"
-        ]):
-            context.user_data["translated"] = digen_ready_prompt
-        else:
-            logger.warning(f"[GEMINI FILTERED] Prompt rad etildi: '{original_prompt}' → '{digen_ready_prompt}'. Asl matn saqlanadi.")
-            context.user_data["translated"] = original_prompt
-
-    except Exception as gemini_err:
-        logger.error(f"[GEMINI PROMPT ERROR] {gemini_err}")
-        context.user_data["translated"] = original_prompt
-    # --- Yangi tugadi ---
+    # --- Tarjima fonda boshlanadi, tugmalar darhol ko'rsatiladi; generate_cb natijani kutadi ---
+    start_prompt_translation(context, prompt)
 
     # ❗ Mana shu qism funksiya ichida bo‘lishi shart
     if flow is None:
@@ -2619,7 +4943,6 @@ async def private_text_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     parse_mode="MarkdownV2",
     reply_markup=InlineKeyboardMarkup(kb)
 )
-        )
 async def gen_image_from_prompt_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
@@ -2628,11 +4951,7 @@ async def gen_image_from_prompt_handler(update: Update, context: ContextTypes.DE
     context.user_data["flow"] = "image_pending_prompt"
 
     # Til
-    lang_code = DEFAULT_LANGUAGE
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", q.from_user.id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], q.from_user.id)
     lang = get_lang(lang_code)
 
     prompt = context.user_data.get("prompt", "")
@@ -2656,35 +4975,10 @@ async def ai_chat_from_prompt_handler(update: Update, context: ContextTypes.DEFA
     await q.answer()
     # AI chat flow boshlanadi
     context.user_data["flow"] = "ai"
-    lang_code = DEFAULT_LANGUAGE
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", q.from_user.id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], q.from_user.id)
     lang = get_lang(lang_code)
     # Faqat bitta marta, tarjima qilingan xabarni yuborish
     await q.message.reply_text(lang["ai_prompt_text"])
-# ---------------- Digen headers (thread-safe) ----------------
-_digen_key_index = 0
-_digen_lock = threading.Lock()
-
-def get_digen_headers():
-    global _digen_key_index
-    if not DIGEN_KEYS:
-        return {}
-    with _digen_lock:
-        key = DIGEN_KEYS[_digen_key_index % len(DIGEN_KEYS)]
-        _digen_key_index += 1
-    return {
-        "accept": "application/json, text/plain, */*",
-        "content-type": "application/json",
-        "digen-language": "en-US",
-        "digen-platform": "web",
-        "digen-token": key.get("token", ""),
-        "digen-sessionid": key.get("session", ""),
-        "origin": "https://digen.ai/image",
-        "referer": "https://digen.ai/image",
-    }
 # ---------------- Asosiy handler: generate_cb ----------------
 async def generate_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -2693,11 +4987,7 @@ async def generate_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pool = context.application.bot_data["db_pool"]
 
     # Til
-    lang_code = DEFAULT_LANGUAGE
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", q.from_user.id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(pool, q.from_user.id)
     lang = get_lang(lang_code)
 
     try:
@@ -2708,7 +4998,19 @@ async def generate_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user = q.from_user
     prompt = context.user_data.get("prompt", "")
-    translated = context.user_data.get("translated", prompt)
+    translated = await await_prompt_translation(context, prompt)
+
+    # --- Taqiqlangan so'zlar: Digen va kvotaga tegmasdan rad etiladi ---
+    if prompt_blocked(prompt, translated, lang_code):
+        logger.info(f"[PROMPT BLOCKED] user={user.id} prompt={prompt[:80]!r}")
+        await q.edit_message_text(lang["prompt_blocked"])
+        return
+
+    # --- Digen ishlamayotgan bo'lsa (breaker ochiq) ---
+    breaker = context.application.bot_data["digen_breaker"]
+    if breaker.is_open() and DIGEN_BREAKER_MODE == "reject":
+        await q.edit_message_text(lang["digen_unavailable"])
+        return
 
     # --- Daily quota check ---
     ok, info = await reserve_quota_or_explain(pool, user.id, count)
@@ -2758,126 +5060,357 @@ Qo'shimcha limit olish uchun Stars orqali pack xarid qiling."""
         await q.edit_message_text(lang["error"])
         return
 
+    # 🔹 Generatsiya DB ga job sifatida yoziladi va navbatga qo'yiladi (worker pool bajaradi)
+    accepted = await enqueue_generation(
+        context,
+        user=user,
+        chat_id=q.message.chat_id,
+        lang_code=lang_code,
+        prompt=prompt,
+        translated=translated,
+        count=count,
+        paid_credits_used=int(info.get("need_paid", 0) or 0),
+        reserved_day=info.get("day")
+    )
+    if not accepted:
+        await q.edit_message_text(lang["queue_full"])
+        return
+
     # 🔹 Foydalanuvchiga bitta xabar
+    if breaker.is_open():
+        await q.edit_message_text(lang["digen_parked"])
+        return
     await q.edit_message_text(lang.get("generating_content", "✨ Generating your content... Please hold on a moment."))
 
-    # 🔹 Orqa fonda generatsiya — progress yo‘q
-    asyncio.create_task(
-        _background_generate(
-            context=context,
-            user=user,
-            prompt=prompt,
-            translated=translated,
-            count=count,
-            chat_id=q.message.chat_id,
-            lang=lang,
-            paid_credits_used=int(info.get("need_paid", 0) or 0)
+# ---------------- Digen circuit breaker ----------------
+DIGEN_BREAKER_WINDOW = int(os.getenv("DIGEN_BREAKER_WINDOW", "20"))
+DIGEN_BREAKER_MIN_CALLS = int(os.getenv("DIGEN_BREAKER_MIN_CALLS", "8"))
+DIGEN_BREAKER_FAILURE_RATE = float(os.getenv("DIGEN_BREAKER_FAILURE_RATE", "0.5"))
+DIGEN_BREAKER_OPEN_SECONDS = float(os.getenv("DIGEN_BREAKER_OPEN_SECONDS", "60"))
+DIGEN_BREAKER_PROBES = int(os.getenv("DIGEN_BREAKER_PROBES", "2"))
+# "park" — yangi joblar navbatda kutadi; "reject" — darhol rad etiladi
+DIGEN_BREAKER_MODE = os.getenv("DIGEN_BREAKER_MODE", "park")
+# Park qilingan job shuncha soniyadan ko'p kutmaydi: failed qilinadi va kvota qaytariladi
+DIGEN_BREAKER_PARK_DEADLINE = float(os.getenv("DIGEN_BREAKER_PARK_DEADLINE", "900"))
+
+class CircuitBreaker:
+    """Oxirgi N natija bo'yicha xatolik ulushi chegaradan oshsa ochiladi (open).
+
+    open_seconds o'tgach half_open holatida bir nechta probe job o'tkaziladi: hammasi
+    muvaffaqiyatli bo'lsa yopiladi (closed), bittasi yiqilsa qayta ochiladi.
+    try_acquire() ticket qaytaradi ("call" yoki "probe"), natija record(ticket, success)
+    bilan yoziladi; success=None — neytral natija (faqat probe o'rnini bo'shatadi).
+    """
+
+    def __init__(self, name, window, min_calls, failure_rate, open_seconds, probes, on_change=None):
+        self.name = name
+        self.min_calls = max(int(min_calls), 1)
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.probes = max(int(probes), 1)
+        self.on_change = on_change
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trips = 0
+        self._results = deque(maxlen=max(int(window), 1))
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+
+    def is_open(self):
+        return self.state == "open" and time.monotonic() < self.opened_at + self.open_seconds
+
+    def failure_ratio(self):
+        if not self._results:
+            return 0.0
+        return self._results.count(False) / len(self._results)
+
+    def try_acquire(self):
+        if self.state == "open":
+            if time.monotonic() < self.opened_at + self.open_seconds:
+                return None
+            self._set_state("half_open")
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+        if self.state == "half_open":
+            if self._probes_in_flight >= self.probes:
+                return None
+            self._probes_in_flight += 1
+            return "probe"
+        return "call"
+
+    async def wait_for_ticket(self, timeout=None):
+        """Breaker o'tkazmaguncha kutadi (park rejimi). timeout o'tsa asyncio.TimeoutError."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            ticket = self.try_acquire()
+            if ticket:
+                return ticket
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise asyncio.TimeoutError("Breaker park muddati tugadi")
+            remaining = self.opened_at + self.open_seconds - now
+            delay = min(max(remaining, 0.5), 5)
+            if deadline is not None:
+                delay = min(delay, max(deadline - now, 0))
+            await asyncio.sleep(delay)
+
+    def record(self, ticket, success):
+        if ticket == "probe":
+            self._probes_in_flight = max(self._probes_in_flight - 1, 0)
+            if self.state != "half_open" or success is None:
+                return
+            if not success:
+                self._trip()
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.probes:
+                self._results.clear()
+                self._set_state("closed")
+            return
+        if success is None:
+            return
+        self._results.append(bool(success))
+        if (
+            self.state == "closed"
+            and len(self._results) >= self.min_calls
+            and self.failure_ratio() >= self.failure_rate
+        ):
+            self._trip()
+
+    def _trip(self):
+        self.trips += 1
+        self.opened_at = time.monotonic()
+        self._set_state("open")
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        old, self.state = self.state, state
+        logger.warning(f"[BREAKER {self.name}] {old} -> {state} (xatolik ulushi {self.failure_ratio():.0%})")
+        if self.on_change:
+            try:
+                self.on_change(old, state)
+            except Exception as e:
+                logger.warning(f"[BREAKER {self.name}] on_change xatosi: {e}")
+
+def _digen_breaker_notifier(app):
+    """Breaker holati o'zgarganda adminga bitta xabar (har job uchun emas)."""
+    # Yuborilayotgan xabarlar — on_shutdown bekor qiladi
+    tasks = app.bot_data.setdefault("notify_tasks", set())
+
+    def _notify(old, new):
+        if not ADMIN_ID or new == "half_open":
+            return
+        if new == "open":
+            text = (
+                f"🚨 Digen circuit breaker OCHILDI ({DIGEN_BREAKER_MODE} rejimi).\n"
+                f"Yangi joblar {int(DIGEN_BREAKER_OPEN_SECONDS)}s dan keyin probe bilan tekshiriladi."
+            )
+        else:
+            text = "✅ Digen circuit breaker yopildi — xizmat tiklandi."
+        task = asyncio.create_task(app.bot.send_message(chat_id=ADMIN_ID, text=text))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    return _notify
+
+# ---------------- Generatsiya joblari (DB) ----------------
+# Job holatlari: queued -> submitted -> polling -> delivering -> done / failed
+GEN_JOB_ACTIVE_STATES = ("queued", "submitted", "polling", "delivering")
+GEN_JOB_STALE_SECONDS = int(os.getenv("GEN_JOB_STALE_SECONDS", "90"))
+GEN_JOB_SWEEP_SECONDS = int(os.getenv("GEN_JOB_SWEEP_SECONDS", "20"))
+GEN_JOB_MAX_ATTEMPTS = int(os.getenv("GEN_JOB_MAX_ATTEMPTS", "3"))
+# Har bir bot jarayoni o'z joblarini shu ID bilan belgilaydi
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+async def create_generation_job(pool, user, chat_id, lang_code, prompt, translated, count, paid_credits, reserved_day):
+    async with pool.acquire() as conn:
+        return await conn.fetchval(
+            "INSERT INTO generation_jobs(user_id, username, chat_id, lang_code, prompt, translated_prompt, "
+            "image_count, paid_credits, reserved_day, state, heartbeat_at, worker_id) "
+            "VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9,'queued',now(),$10) RETURNING id",
+            user.id, user.username if user.username else None, chat_id, lang_code,
+            prompt, translated, count, paid_credits, reserved_day, WORKER_ID
         )
+
+async def set_generation_job_state(pool, job_id, state, **fields):
+    updates = ["state=$2", "heartbeat_at=now()"]
+    params = [job_id, state]
+    for col, value in fields.items():
+        params.append(value)
+        updates.append(f"{col}=${len(params)}")
+    if state in ("done", "failed"):
+        updates.append("finished_at=now()")
+    async with pool.acquire() as conn:
+        await conn.execute(f"UPDATE generation_jobs SET {', '.join(updates)} WHERE id=$1", *params)
+
+GEN_JOB_FAIL_RETRIES = 3
+
+async def finish_generation_job(pool, job_id, state, **fields):
+    """Yakuniy holatni (done / failed) bir necha urinish bilan yozadi. Yozildimi — True."""
+    for attempt in range(GEN_JOB_FAIL_RETRIES):
+        try:
+            await set_generation_job_state(pool, job_id, state, **fields)
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"[JOB {job_id}] {state} holatini yozib bo'lmadi ({attempt + 1}/{GEN_JOB_FAIL_RETRIES}): {e}")
+            await asyncio.sleep(2 ** attempt)
+    return False
+
+async def fail_generation_job(pool, job, reason):
+    """Jobni failed qiladi, so'ng limit va kreditni qaytaradi. Holatni yozib bo'lmasa kvota qaytarilmaydi:
+    job heartbeat'siz qoladi va eskirgach boshqa worker uni olib, o'zi yakunlaydi (ikki marta refund bo'lmaydi)."""
+    if not await finish_generation_job(pool, job["id"], "failed", error=str(reason)[:500]):
+        return False
+    await release_quota(pool, job["user_id"], job["reserved_day"], job["image_count"], job["paid_credits"] or 0)
+    return True
+
+async def claim_generation_job(pool, job_id):
+    """Jobni shu jarayon nomiga oladi. Boshqa jarayon band qilgan bo'lsa None."""
+    async with pool.acquire() as conn:
+        return await conn.fetchrow(
+            "UPDATE generation_jobs SET worker_id=$2, heartbeat_at=now(), attempts=attempts+1 "
+            "WHERE id = ("
+            "  SELECT id FROM generation_jobs WHERE id=$1 AND state = ANY($3::text[]) "
+            "  AND (worker_id IS NULL OR worker_id=$2 OR heartbeat_at < now() - make_interval(secs => $4)) "
+            "  FOR UPDATE SKIP LOCKED"
+            ") RETURNING *",
+            job_id, WORKER_ID, list(GEN_JOB_ACTIVE_STATES), GEN_JOB_STALE_SECONDS
+        )
+
+async def enqueue_generation(context, user, chat_id, lang_code, prompt, translated, count, paid_credits_used, reserved_day):
+    """Jobni DB ga yozib, navbatga qo'yadi. Navbat to'la bo'lsa limit va kredit qaytariladi va False."""
+    pool = context.application.bot_data["db_pool"]
+    gen_queue = context.application.bot_data["gen_queue"]
+    if gen_queue.full():
+        gen_queue.stats["rejected"] += 1
+        await release_quota(pool, user.id, reserved_day, count, paid_credits_used)
+        return False
+    job_id = await create_generation_job(
+        pool, user, chat_id, lang_code, prompt, translated, count, paid_credits_used, reserved_day
     )
+    if not gen_queue.submit(job_id):
+        await set_generation_job_state(pool, job_id, "failed", error="queue full")
+        await release_quota(pool, user.id, reserved_day, count, paid_credits_used)
+        return False
+    return True
 
 # ---------------- Orqa fonda generatsiya ----------------
 
-async def _background_generate(context, user, prompt, translated, count, chat_id, lang, paid_credits_used=0):
+async def _background_generate(app, job, ticket="call"):
     start_time = time.time()
-    lora_id = ""
-    background_prompt = ""
-
-    # --- Modelni olish va background prompt tanlash ---
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT image_model_id FROM users WHERE id = $1", user.id)
-        if row and row["image_model_id"]:
-            lora_id = row["image_model_id"]
-            selected_model = next((m for m in DIGEN_MODELS if m["id"] == lora_id), None)
-            if selected_model and "background_prompts" in selected_model:
-                background_prompt = random.choice(selected_model["background_prompts"])
-        if not background_prompt:
-            background_prompt = random.choice([
-                "high quality, 8k, sharp focus",
-                "ultra-detailed, professional photography",
-                "cinematic lighting, vibrant colors"
-            ])
-
-    final_prompt = f"{translated}, {background_prompt}".strip()
-    payload = {
-        "prompt": final_prompt,
-        "image_size": "768x1368",
-        "width": 768,
-        "height": 1368,
-        "lora_id": lora_id,
-        "batch_size": count,
-        "model": "flux2-klein",
-        "resolution_model": "9:16",
-        "reference_images": [],
-        "strength": "0.9"
-    }
-
-    headers = get_digen_headers()
-
-    async def _refund_if_needed():
-        if paid_credits_used and int(paid_credits_used) > 0:
-            try:
-                async with context.application.bot_data["db_pool"].acquire() as conn:
-                    await conn.execute(
-                        "UPDATE users SET extra_credits = COALESCE(extra_credits, 0) + $1 WHERE id = $2",
-                        int(paid_credits_used), user.id
-                    )
-            except Exception as e:
-                logger.warning(f"[CREDIT REFUND FAILED] {e}")
+    pool = app.bot_data["db_pool"]
+    breaker = app.bot_data["digen_breaker"]
+    context = app.context_types.context(app)
+    job_id = job["id"]
+    user = telegram.User(id=job["user_id"], first_name="", is_bot=False, username=job["username"])
+    prompt = job["prompt"] or ""
+    translated = job["translated_prompt"] or prompt
+    count = int(job["image_count"])
+    chat_id = job["chat_id"]
+    lang = get_lang(job["lang_code"])
+
+    image_id = job["image_id"]
+    lora_id = job["lora_id"] or ""
+    final_prompt = job["final_prompt"] or translated
+    headers = {}
+    # Rasmlar yuborilgandan keyin kvota qaytarilmaydi va foydalanuvchiga xato ko'rsatilmaydi
+    delivered = False
+
+    def _breaker_record(success):
+        # Har bir job natijasi breaker'ga faqat bir marta yoziladi
+        nonlocal ticket
+        if ticket:
+            breaker.record(ticket, success)
+            ticket = None
+
+    async def _fail(reason):
+        try:
+            await fail_generation_job(pool, job, reason)
+        except Exception as e:
+            logger.warning(f"[JOB {job_id}] kvotani qaytarib bo'lmadi: {e}")
 
     try:
-        # --- Digen API chaqiruvi ---
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=500)) as session:
-            async with session.post(DIGEN_URL, headers=headers, json=payload) as resp:
-                if resp.status != 200:
-                    logger.error(f"[DIGEN ERROR] Status {resp.status}, Body: {await resp.text()}")
-                    await context.bot.send_message(chat_id, lang["error"])
-                    await _refund_if_needed()
-                    return
-                data = await resp.json()
-
-        image_id = (data.get("data") or {}).get("id") or data.get("id")
         if not image_id:
-            logger.error(f"[DIGEN] Image ID topilmadi. Javob: {data}")
-            await context.bot.send_message(chat_id, lang["error"])
-            await _refund_if_needed()
-            return
+            background_prompt = ""
+
+            # --- Modelni olish va background prompt tanlash ---
+            profile = await get_user_profile(pool, user.id)
+            if profile and profile.image_model_id:
+                lora_id = profile.image_model_id
+                selected_model = next((m for m in DIGEN_MODELS if m["id"] == lora_id), None)
+                if selected_model and "background_prompts" in selected_model:
+                    background_prompt = random.choice(selected_model["background_prompts"])
+            if not background_prompt:
+                background_prompt = random.choice([
+                    "high quality, 8k, sharp focus",
+                    "ultra-detailed, professional photography",
+                    "cinematic lighting, vibrant colors"
+                ])
+
+            final_prompt = f"{translated}, {background_prompt}".strip()
+            payload = {
+                "prompt": final_prompt,
+                "image_size": "768x1368",
+                "width": 768,
+                "height": 1368,
+                "lora_id": lora_id,
+                "batch_size": count,
+                "model": "flux2-klein",
+                "resolution_model": "9:16",
+                "reference_images": [],
+                "strength": "0.9"
+            }
+
+            # --- Digen API chaqiruvi (kalitni pul tanlaydi) ---
+            try:
+                image_id, key = await digen_submit(app, payload)
+            except DigenSubmitError as e:
+                logger.error(f"[DIGEN ERROR] {e}")
+                # 5xx/tarmoq — Digen muammosi; 4xx esa kalitga tegishli (uni kalitlar puli hal qiladi)
+                _breaker_record(False if e.status is None or e.status >= 500 else None)
+                await context.bot.send_message(chat_id, lang["error"])
+                await _fail(e)
+                return False
+            headers = key.headers()
+
+            await set_generation_job_state(
+                pool, job_id, "submitted",
+                image_id=image_id,
+                digen_key=key.label,
+                final_prompt=final_prompt,
+                lora_id=lora_id,
+                submitted_at=utc_now()
+            )
+        else:
+            # Restartdan keyin: Digen ga qayta yubormaymiz, faqat tayyorlikni kutamiz
+            logger.info(f"[JOB {job_id}] image_id={image_id} bo'yicha polling davom ettirilmoqda")
 
        # ✅ To'g'ri versiya:
         image_id_clean = str(image_id).strip()
         urls = [f"https://liveme-image.s3.amazonaws.com/{image_id_clean}-{i}.jpeg".strip() for i in range(count)]
         logger.info(f"[GENERATE] Cleaned urls: {urls}")
+        await set_generation_job_state(pool, job_id, "polling")
 
-        # --- Rasm tayyor bo‘lganligini sinab ko‘rish (30 soniya maks, 5 sek interval) ---
-        image_ready = False
-        for attempt in range(350):
-            try:
-                # Birinchi rasmni tekshiramiz
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=50)) as check_session:
-                    async with check_session.head(urls[0], allow_redirects=True) as head_resp:
-                        if head_resp.status == 200:
-                            image_ready = True
-                            break
-            except Exception as e:
-                logger.debug(f"[CHECK] Attempt {attempt+1}/30 failed for {urls[0]}: {e}")
-            await asyncio.sleep(2)
-
-        if not image_ready:
-            # HEAD ishlamasa, GET sinab ko'rish (bir marta)
-            try:
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=350)) as check_session:
-                    async with check_session.get(urls[0], timeout=350) as get_resp:
-                        if get_resp.status == 200:
-                            image_ready = True
-                        else:
-                            logger.warning(f"[CHECK] GET status: {get_resp.status}")
-            except Exception as e:
-                logger.exception(f"[CHECK FINAL GET FAILED] {e}")
+        # --- Rasm tayyorligini markaziy poller kutadi (backoff + qat'iy deadline) ---
+        deadline = READY_POLL_DEADLINE
+        if job["submitted_at"]:
+            # Tiklangan job: Digen ga yuborilgandan beri o'tgan vaqt hisobga olinadi
+            elapsed = (utc_now() - job["submitted_at"]).total_seconds()
+            deadline = max(READY_POLL_DEADLINE - elapsed, READY_POLL_RESUME_MIN)
+        image_ready = await app.bot_data["ready_poller"].wait_ready(urls[0], deadline)
+        _breaker_record(bool(image_ready))
 
         if not image_ready:
             await context.bot.send_message(chat_id, lang["image_delayed"])
-            await _refund_if_needed()
-            await notify_admin_on_error(context, user, prompt, headers, Exception("Image delay timeout"), count)
-            return
+            await _fail("Image delay timeout")
+            # Breaker ochiq bo'lsa admin bitta umumiy xabar olgan, har job uchun yubormaymiz
+            if not breaker.is_open():
+                await notify_admin_on_error(context, user, prompt, headers, Exception("Image delay timeout"), count)
+            return False
+
+        await set_generation_job_state(pool, job_id, "delivering")
 
         # --- Caption tayyorlash ---
         escaped_prompt = escape_md(prompt)
@@ -2906,8 +5439,8 @@ async def _background_generate(context, user, prompt, translated, count, chat_id
             except Exception as e:
                 logger.error(f"[MEDIA BUILD ERROR] index={i}, url={url}: {e}")
                 await context.bot.send_message(chat_id, lang["error"])
-                await _refund_if_needed()
-                return
+                await _fail(f"Media build error: {e}")
+                return False
 
         # --- Media group yuborishda timeoutni oshirish (va retry) ---
         success = False
@@ -2939,23 +5472,338 @@ async def _background_generate(context, user, prompt, translated, count, chat_id
 
         if not success:
             raise telegram.error.TimedOut("All retries failed")
+        delivered = True
 
-        # --- Loglash va admin xabari ---
-        await log_generation(context.application.bot_data["db_pool"], user, prompt, final_prompt, image_id, count)
+        # --- Loglash va admin xabari (xatosi yetkazilgan rasmlarga ta'sir qilmaydi) ---
+        try:
+            await log_generation(pool, user, prompt, final_prompt, image_id, count)
+        except Exception as e:
+            logger.exception(f"[JOB {job_id}] generatsiya logi yozilmadi: {e}")
+        if not await finish_generation_job(pool, job_id, "done"):
+            logger.error(f"[JOB {job_id}] rasmlar yuborildi, lekin done holati yozilmadi")
+        logger.info(f"[JOB {job_id}] tayyor ({time.time() - start_time:.1f}s)")
         if ADMIN_ID and urls:
-            await notify_admin_generation(context, user, prompt, urls, count, image_id)
+            try:
+                await notify_admin_generation(context, user, prompt, urls, count, image_id)
+            except Exception as e:
+                logger.warning(f"[ADMIN NOTIFY FAILED] {e}")
+        return True
 
     except Exception as e:
-        await _refund_if_needed()
+        if delivered:
+            logger.exception(f"[JOB {job_id}] yetkazilgandan keyingi xato: {e}")
+            return True
+        if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)) and not image_id:
+            # Submit paytidagi tarmoq xatosi (kalit kutish — DigenKeysUnavailable — bu yerga tushmaydi)
+            _breaker_record(False)
+        await _fail(e)
         logger.exception(f"[BACKGROUND GENERATE ERROR] {e}")
         try:
             await context.bot.send_message(chat_id, lang["error"])
         except:
             pass
         try:
-            await notify_admin_on_error(context, user, prompt, headers, e, count)
+            if not breaker.is_open():
+                await notify_admin_on_error(context, user, prompt, headers, e, count)
         except Exception as ne:
             logger.exception(f"[ADMIN NOTIFY FAILED] {ne}")
+        return False
+    finally:
+        _breaker_record(None)
+
+# ---------------- Rasm tayyorligini tekshirish (markaziy scheduler) ----------------
+READY_POLL_CONCURRENCY = int(os.getenv("READY_POLL_CONCURRENCY", "16"))
+READY_POLL_BASE_DELAY = float(os.getenv("READY_POLL_BASE_DELAY", "2"))
+READY_POLL_MAX_DELAY = float(os.getenv("READY_POLL_MAX_DELAY", "20"))
+READY_POLL_HEAD_TIMEOUT = float(os.getenv("READY_POLL_HEAD_TIMEOUT", "10"))
+READY_POLL_DEADLINE = float(os.getenv("READY_POLL_DEADLINE", "700"))
+READY_POLL_RESUME_MIN = float(os.getenv("READY_POLL_RESUME_MIN", "60"))
+
+class ReadinessPoller:
+    """Barcha kutilayotgan image_id lar uchun yagona heap (keyingi tekshiruv vaqti bo'yicha).
+
+    HEAD so'rovlar umumiy semafor bilan cheklanadi, har bir job o'z backoff'i (jitter bilan)
+    va qat'iy deadline'iga ega. Rasm tayyor bo'lsa kutayotgan jobning future'i True bo'ladi,
+    deadline o'tsa False.
+    """
+
+    def __init__(self, app, concurrency):
+        self.app = app
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._sem = asyncio.Semaphore(max(int(concurrency), 1))
+        self._task = None
+        # Ishlayotgan HEAD tekshiruvlari (task -> entry) — stop() ularni bekor qilib kutadi
+        self._checks = {}
+        self.stats = {"checks": 0, "ready": 0, "timeouts": 0, "errors": 0}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name="ready-poller")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        checks = dict(self._checks)
+        for task in checks:
+            task.cancel()
+        await asyncio.gather(*checks, return_exceptions=True)
+        for entry in itertools.chain(checks.values(), (e for _, _, e in self._heap)):
+            if not entry["future"].done():
+                entry["future"].cancel()
+        self._heap.clear()
+
+    def pending(self):
+        return sum(1 for _, _, e in self._heap if not e["future"].done())
+
+    def wait_ready(self, url, timeout):
+        """URL tayyor bo'lguncha kutadigan future qaytaradi (timeout soniyadan keyin False)."""
+        future = asyncio.get_running_loop().create_future()
+        entry = {"url": url, "future": future, "deadline": time.monotonic() + timeout, "attempt": 0}
+        self._schedule(entry, 0)
+        return future
+
+    def _schedule(self, entry, delay):
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), entry))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            due, _, entry = self._heap[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            if entry["future"].done():
+                # Kutayotgan job bekor qilingan
+                continue
+            try:
+                await self._sem.acquire()
+            except asyncio.CancelledError:
+                # Navbatga qaytariladi — stop() uning future'ini bekor qiladi
+                self._schedule(entry, 0)
+                raise
+            task = asyncio.create_task(self._check(entry))
+            self._checks[task] = entry
+            task.add_done_callback(lambda t: self._checks.pop(t, None))
+
+    async def _check(self, entry):
+        try:
+            ready = False
+            self.stats["checks"] += 1
+            try:
+                async with http_session(self.app, "s3").head(
+                    entry["url"], allow_redirects=True,
+                    timeout=aiohttp.ClientTimeout(total=READY_POLL_HEAD_TIMEOUT)
+                ) as resp:
+                    ready = resp.status == 200
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.debug(f"[CHECK] {entry['url']} attempt {entry['attempt'] + 1}: {e}")
+
+            future = entry["future"]
+            if future.done():
+                return
+            now = time.monotonic()
+            if ready:
+                self.stats["ready"] += 1
+                future.set_result(True)
+            elif now >= entry["deadline"]:
+                self.stats["timeouts"] += 1
+                future.set_result(False)
+            else:
+                entry["attempt"] += 1
+                backoff = min(READY_POLL_BASE_DELAY * (1.5 ** entry["attempt"]), READY_POLL_MAX_DELAY)
+                delay = random.uniform(backoff / 2, backoff)
+                self._schedule(entry, min(delay, max(entry["deadline"] - now, 0)))
+        finally:
+            self._sem.release()
+
+# ---------------- Generatsiya navbati (worker pool) ----------------
+# Worker soni Digen kalitlari sig'imiga mos bo'lishi kerak (kalitlar soni × DIGEN_KEY_MAX_CONCURRENCY)
+GEN_WORKERS = int(os.getenv("GEN_WORKERS", str(max(len(DIGEN_KEYS), 1) * DIGEN_KEY_MAX_CONCURRENCY)))
+GEN_QUEUE_MAX = int(os.getenv("GEN_QUEUE_MAX", "200"))
+
+class GenerationQueue:
+    """Cheklangan navbat: worker'lar generation_jobs dagi joblarni ID bo'yicha bajaradi.
+
+    Navbatda faqat job ID lar turadi, holat esa DB da. Sweeper boshqa jarayon tashlab
+    ketgan (heartbeat eskirgan) yoki hech kim olmagan joblarni FOR UPDATE SKIP LOCKED bilan
+    o'ziga oladi, shuning uchun restartdan keyin ham joblar davom etadi.
+    """
+
+    def __init__(self, app, workers, maxsize):
+        self.app = app
+        self.workers = max(int(workers), 1)
+        self.queue = asyncio.Queue(maxsize=max(int(maxsize), 1))
+        self._tasks = []
+        # job_id -> navbatga qo'yilgan vaqt; job tugaguncha (worker ishlayotganda ham) shu yerda turadi,
+        # shuning uchun sweeper uni qayta navbatga qo'ymaydi va heartbeat faqat shularga yuboriladi
+        self._pending = {}
+        # Hozir shu jarayondagi worker'lar bajarayotgan joblar
+        self._running = set()
+        self.busy = 0
+        self.parked = 0
+        self.stats = {
+            "enqueued": 0,
+            "rejected": 0,
+            "recovered": 0,
+            "done": 0,
+            "failed": 0,
+            "park_timeouts": 0,
+            "max_depth": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+
+    def start(self):
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(i), name=f"gen-worker-{i}"))
+        self._tasks.append(asyncio.create_task(self._sweeper(), name="gen-sweeper"))
+        logger.info(f"[GEN QUEUE] {self.workers} ta worker ishga tushdi (max navbat: {self.queue.maxsize}, id: {WORKER_ID})")
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def full(self):
+        return self.queue.full()
+
+    def submit(self, job_id) -> bool:
+        """Job ID ni navbatga qo'yadi. Navbat to'la bo'lsa False (backpressure)."""
+        if job_id in self._pending:
+            return True
+        try:
+            self.queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            logger.warning(f"[GEN QUEUE] Navbat to'la ({self.queue.qsize()}), job {job_id} rad etildi")
+            return False
+        self._pending[job_id] = time.monotonic()
+        self.stats["enqueued"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.queue.qsize())
+        return True
+
+    async def _worker(self, idx):
+        pool = self.app.bot_data["db_pool"]
+        while True:
+            job_id = await self.queue.get()
+            if job_id in self._running:
+                # Bir job ikki local worker'da bajarilmaydi (Digen ikki marta chaqirilmasin)
+                self.queue.task_done()
+                continue
+            self._running.add(job_id)
+            wait = time.monotonic() - self._pending.get(job_id, time.monotonic())
+            self.stats["wait_total"] += wait
+            self.stats["wait_max"] = max(self.stats["wait_max"], wait)
+            self.busy += 1
+            try:
+                job = await claim_generation_job(pool, job_id)
+                if not job:
+                    # Boshqa jarayon olgan yoki allaqachon tugagan
+                    continue
+                if job["attempts"] > GEN_JOB_MAX_ATTEMPTS:
+                    logger.error(f"[GEN WORKER {idx}] Job {job_id} {GEN_JOB_MAX_ATTEMPTS} marta urinildi, bekor qilindi")
+                    await fail_generation_job(pool, job, "max attempts")
+                    self.stats["failed"] += 1
+                    continue
+                ticket = "call"
+                if not job["image_id"]:
+                    # Digen ga yuborishdan oldin breaker ruxsatini olamiz; ochiq bo'lsa job kutib turadi
+                    breaker = self.app.bot_data["digen_breaker"]
+                    ticket = breaker.try_acquire()
+                    if ticket is None:
+                        self.parked += 1
+                        try:
+                            ticket = await breaker.wait_for_ticket(DIGEN_BREAKER_PARK_DEADLINE)
+                        except asyncio.TimeoutError:
+                            logger.warning(f"[GEN WORKER {idx}] Job {job_id} {int(DIGEN_BREAKER_PARK_DEADLINE)}s park qilindi, bekor qilindi")
+                            await fail_generation_job(pool, job, "breaker park timeout")
+                            self.stats["failed"] += 1
+                            self.stats["park_timeouts"] += 1
+                            try:
+                                await self.app.bot.send_message(job["chat_id"], get_lang(job["lang_code"])["digen_park_timeout"])
+                            except TelegramError as e:
+                                logger.warning(f"[GEN WORKER {idx}] Park timeout xabari yuborilmadi: {e}")
+                            continue
+                        finally:
+                            self.parked -= 1
+                if await _background_generate(self.app, job, ticket):
+                    self.stats["done"] += 1
+                else:
+                    self.stats["failed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.exception(f"[GEN WORKER {idx}] {e}")
+            finally:
+                self._running.discard(job_id)
+                self._pending.pop(job_id, None)
+                self.busy -= 1
+                self.queue.task_done()
+
+    async def _sweeper(self):
+        pool = self.app.bot_data["db_pool"]
+        while True:
+            try:
+                async with pool.acquire() as conn:
+                    # Heartbeat faqat shu jarayonda haqiqatan navbatda yoki ishlanayotgan joblarga —
+                    # yetim qolgan joblar eskiradi va qayta olinadi
+                    owned = list(self._pending)
+                    await conn.execute(
+                        "UPDATE generation_jobs SET heartbeat_at=now() "
+                        "WHERE worker_id=$1 AND state = ANY($2::text[]) AND id = ANY($3::bigint[])",
+                        WORKER_ID, list(GEN_JOB_ACTIVE_STATES), owned
+                    )
+                    free = self.queue.maxsize - self.queue.qsize()
+                    rows = []
+                    if free > 0:
+                        rows = await conn.fetch(
+                            "UPDATE generation_jobs SET worker_id=$1, heartbeat_at=now() "
+                            "WHERE id IN ("
+                            "  SELECT id FROM generation_jobs WHERE state = ANY($2::text[]) "
+                            "  AND (worker_id IS NULL OR heartbeat_at < now() - make_interval(secs => $3)) "
+                            "  AND NOT (id = ANY($5::bigint[])) "
+                            "  ORDER BY id LIMIT $4 FOR UPDATE SKIP LOCKED"
+                            ") RETURNING id",
+                            WORKER_ID, list(GEN_JOB_ACTIVE_STATES), GEN_JOB_STALE_SECONDS, free, owned
+                        )
+                for r in rows:
+                    if r["id"] not in self._pending and self.submit(r["id"]):
+                        self.stats["recovered"] += 1
+                if rows:
+                    logger.info(f"[GEN QUEUE] {len(rows)} ta job tiklandi/olindi")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[GEN SWEEPER] {e}")
+            await asyncio.sleep(GEN_JOB_SWEEP_SECONDS)
+
+    def snapshot(self):
+        started = self.stats["done"] + self.stats["failed"] + self.busy
+        avg_wait = self.stats["wait_total"] / started if started else 0.0
+        return {
+            "depth": self.queue.qsize(),
+            "max_size": self.queue.maxsize,
+            "workers": self.workers,
+            "busy": self.busy,
+            "parked": self.parked,
+            "avg_wait": avg_wait,
+            **self.stats,
+        }
 
 # ---------------- Buy extra images (Stars) ----------------
 async def buy_pack_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2992,17 +5840,11 @@ async def donate_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     lang_code = DEFAULT_LANGUAGE
     if update.callback_query:
-        async with context.application.bot_data["db_pool"].acquire() as conn:
-            row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", update.callback_query.from_user.id)
-            if row:
-                lang_code = row["language_code"]
+        lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], update.callback_query.from_user.id)
         await update.callback_query.answer()
     else:
         if update.effective_chat.type == "private":
-            async with context.application.bot_data["db_pool"].acquire() as conn:
-                row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", update.effective_user.id)
-                if row:
-                    lang_code = row["language_code"]
+            lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], update.effective_user.id)
 
     lang = get_lang(lang_code)
 
@@ -3023,11 +5865,7 @@ async def donate_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Yangi: donate jarayoni tugadi, belgini o'chiramiz
     context.user_data.pop("current_operation", None)
 
-    lang_code = DEFAULT_LANGUAGE
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", update.effective_user.id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], update.effective_user.id)
     lang = get_lang(lang_code)
 
     txt = update.message.text.strip()
@@ -3073,11 +5911,7 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
     pool = context.application.bot_data["db_pool"]
 
     # til
-    lang_code = DEFAULT_LANGUAGE
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", user.id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(pool, user.id)
     lang = get_lang(lang_code)
 
     payload = payment.invoice_payload or ""
@@ -3103,6 +5937,7 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
                 "UPDATE users SET extra_credits = COALESCE(extra_credits, 0) + $1 WHERE id = $2",
                 credits, user.id
             )
+            await invalidate_user(conn, user.id)
 
         await update.message.reply_text(
             lang.get("quota_pack_thanks", "✅ To'lov qabul qilindi! +{credits} ta qo'shimcha rasm limiti qo'shildi.").format(credits=credits)
@@ -3114,20 +5949,22 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
             try:
                 ok, info = await reserve_quota_or_explain(pool, user.id, int(pending.get("count", 1)))
                 if ok:
-                    await context.bot.send_message(user.id, lang.get("generating_content", "✨ Generating..."))
-                    asyncio.create_task(
-                        _background_generate(
-                            context=context,
-                            user=user,
-                            prompt=pending.get("prompt", ""),
-                            translated=pending.get("translated", pending.get("prompt", "")),
-                            count=int(pending.get("count", 1)),
-                            chat_id=user.id,
-                            lang=lang,
-                            paid_credits_used=int(info.get("need_paid", 0) or 0)
-                        )
+                    accepted = await enqueue_generation(
+                        context,
+                        user=user,
+                        chat_id=user.id,
+                        lang_code=lang_code,
+                        prompt=pending.get("prompt", ""),
+                        translated=pending.get("translated", pending.get("prompt", "")),
+                        count=int(pending.get("count", 1)),
+                        paid_credits_used=int(info.get("need_paid", 0) or 0),
+                        reserved_day=info.get("day")
                     )
-                    context.user_data.pop("pending_generation", None)
+                    if accepted:
+                        await context.bot.send_message(user.id, lang.get("generating_content", "✨ Generating..."))
+                        context.user_data.pop("pending_generation", None)
+                    else:
+                        await context.bot.send_message(user.id, lang["queue_full"])
             except Exception as e:
                 logger.exception(f"[PENDING GENERATION AFTER PAYMENT ERROR] {e}")
         return
@@ -3205,24 +6042,21 @@ async def cmd_public_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, e
         user = update.effective_user
 
     # Tilni olish
-    lang_code = DEFAULT_LANGUAGE
-    async with context.application.bot_data["db_pool"].acquire() as conn:
-        row = await conn.fetchrow("SELECT language_code FROM users WHERE id = $1", user.id)
-        if row:
-            lang_code = row["language_code"]
+    lang_code = await get_user_lang_code(context.application.bot_data["db_pool"], user.id)
     lang = get_lang(lang_code)
 
     pool = context.application.bot_data["db_pool"]
     now = utc_now()
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     thirty_days_ago = now - timedelta(days=30)
 
     async with pool.acquire() as conn:
         total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
         new_users_30d = await conn.fetchval("SELECT COUNT(*) FROM users WHERE first_seen >= $1", thirty_days_ago)
-        total_images = await conn.fetchval("SELECT COALESCE(SUM(image_count), 0) FROM generations")
-        today_images = await conn.fetchval("SELECT COALESCE(SUM(image_count), 0) FROM generations WHERE created_at >= $1", today_start)
-        user_images = await conn.fetchval("SELECT COALESCE(SUM(image_count), 0) FROM generations WHERE user_id = $1", user.id)
+        total_images = await conn.fetchval("SELECT COALESCE(SUM(total_images), 0) FROM users")
+        today_images = await conn.fetchval(
+            "SELECT COALESCE(SUM(images), 0) FROM user_daily_usage WHERE tashkent_day = $1", tashkent_today(now)
+        )
+        user_images = await conn.fetchval("SELECT COALESCE(total_images, 0) FROM users WHERE id = $1", user.id) or 0
 
     fake_ping = random.randint(30, 80)
 
@@ -3275,6 +6109,9 @@ async def admin_panel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     ]
     await q.edit_message_text("🔐 **Admin Panel**", parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
 #------------------------------------------------------------------------------------------
+def _pct(value):
+    return "—" if value is None else f"{value:.0%}"
+
 async def admin_stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
@@ -3282,14 +6119,15 @@ async def admin_stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     await q.answer()
     pool = context.application.bot_data["db_pool"]
     now = utc_now()
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     week_ago = now - timedelta(days=7)
 
     async with pool.acquire() as conn:
         total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
         new_24h = await conn.fetchval("SELECT COUNT(*) FROM users WHERE first_seen >= $1", now - timedelta(hours=24))
-        total_gens = await conn.fetchval("SELECT COALESCE(SUM(image_count), 0) FROM generations")
-        today_gens = await conn.fetchval("SELECT COALESCE(SUM(image_count), 0) FROM generations WHERE created_at >= $1", today_start)
+        total_gens = await conn.fetchval("SELECT COALESCE(SUM(total_images), 0) FROM users")
+        today_gens = await conn.fetchval(
+            "SELECT COALESCE(SUM(images), 0) FROM user_daily_usage WHERE tashkent_day = $1", tashkent_today(now)
+        )
         stars_earned = await conn.fetchval("SELECT COALESCE(SUM(stars), 0) FROM donations WHERE refunded_at IS NULL")
         errors_48h = await conn.fetchval(
             "SELECT COUNT(*) FROM donations d JOIN generations g ON d.user_id = g.user_id "
@@ -3297,7 +6135,13 @@ async def admin_stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
             now - timedelta(hours=48)
         )
         active_7d = await conn.fetchval("SELECT COUNT(DISTINCT user_id) FROM generations WHERE created_at >= $1", week_ago)
+    activity = await activity_summary(pool, tashkent_today(now))
 
+    gq = context.application.bot_data["gen_queue"].snapshot()
+    poller = context.application.bot_data["ready_poller"]
+    ps = poller.stats
+    breaker = context.application.bot_data["digen_breaker"]
+    listener = context.application.bot_data["cache_listener"]
     text = (
         "📊 *Admin Statistika*\n\n"
         f"👥 *Jami foydalanuvchilar:* {total_users}\n"
@@ -3305,8 +6149,31 @@ async def admin_stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"📆 *Bugun generatsiya:* {today_gens}\n"
         f"🖼 *Jami rasmlar:* {total_gens}\n"
         f"💬 *7 kunlik faol:* {active_7d}\n"
+        f"📈 *DAU/WAU/MAU:* {activity['dau']} / {activity['wau']} / {activity['mau']}\n"
+        f"🔁 *Qaytish:* D1 {_pct(activity['d1'])}, D7 {_pct(activity['d7'])}\n"
         f"💎 *Stars daromad:* {stars_earned} XTR\n"
-        f"📉 *48h refund:* {errors_48h}"
+        f"📉 *48h refund:* {errors_48h}\n\n"
+        f"⏳ *Navbat:* {gq['depth']}/{gq['max_size']} (max {gq['max_depth']}, rad: {gq['rejected']}, tiklangan: {gq['recovered']})\n"
+        f"🛡 *Digen breaker:* {breaker.state.replace('_', '-')} (xato {breaker.failure_ratio():.0%}, trip: {breaker.trips}, kutayotgan: {gq['parked']}, park timeout: {gq['park_timeouts']})\n"
+        f"⚙️ *Worker:* {gq['busy']}/{gq['workers']} band | "
+        f"kutish o'rt. {gq['avg_wait']:.1f}s, max {gq['wait_max']:.1f}s\n"
+        f"🔎 *Polling:* {poller.pending()} kutmoqda | {ps['checks']} HEAD, "
+        f"{ps['ready']} tayyor, {ps['timeouts']} timeout\n\n"
+        f"👤 *Profil kesh:* {len(USER_PROFILES)} ta, hit {USER_PROFILES.hits} / miss {USER_PROFILES.misses}\n"
+        f"📢 *Obuna kesh:* {len(SUB_CACHE)} ta, hit {SUB_CACHE.hits} / miss {SUB_CACHE.misses}, "
+        f"API {SUB_CACHE.api_calls}, kanal yangilanishi {SUB_CACHE.updates}\n"
+        f"📡 *Invalidatsiya:* {'ulangan' if listener.connected else 'uzilgan'}, "
+        f"{listener.received} xabar, {listener.reconnects} qayta ulanish\n"
+        f"📝 *Write-behind:* {WRITE_BEHIND.stats_line()}\n"
+        f"🈯 *Tarjima kesh:* {prompt_cache_stats_line()}\n"
+        f"💬 *AI chat:* {ai_chat_stats_line()}\n"
+        f"🧵 *AI chat navbati:* {AI_CHAT_INFLIGHT.stats_line()}\n"
+        f"🧠 *AI chat xotirasi:* {AI_CHAT_MEMORY.stats_line()}\n\n"
+        "🔑 *Gemini kalitlar:*\n" + ("\n".join(GEMINI_KEYS.stats_lines()) or "—") + "\n"
+        f"(byudjet kutishlari: tarjima {GEMINI_KEYS.waits['translate']}, chat {GEMINI_KEYS.waits['chat']}, "
+        f"xulosa {GEMINI_KEYS.waits['summary']})\n"
+        "🧭 *Gemini modellar:*\n" + ("\n".join(gemini_model_stats_lines()) or "—") + "\n\n"
+        "🌐 *HTTP ulanishlar:*\n" + "\n".join(http_stats_lines())
     )
     kb = [
         [InlineKeyboardButton("🔄 Yangilash", callback_data="admin_stats")],
@@ -3397,6 +6264,7 @@ async def admin_ban_inline_handler(update: Update, context: ContextTypes.DEFAULT
     pool = context.application.bot_data["db_pool"]
     async with pool.acquire() as conn:
         await conn.execute("UPDATE users SET is_banned = TRUE WHERE id = $1", user_id)
+        await invalidate_user(conn, user_id)
     await q.answer(f"Foydalanuvchi {user_id} ban qilindi ✅", show_alert=True)
     await admin_show_user_card(context, user_id, q=q)
 
@@ -3409,6 +6277,7 @@ async def admin_unban_inline_handler(update: Update, context: ContextTypes.DEFAU
     pool = context.application.bot_data["db_pool"]
     async with pool.acquire() as conn:
         await conn.execute("UPDATE users SET is_banned = FALSE WHERE id = $1", user_id)
+        await invalidate_user(conn, user_id)
     await q.answer(f"Foydalanuvchi {user_id} bandan chiqarildi ✅", show_alert=True)
     await admin_show_user_card(context, user_id, q=q)
 
@@ -3485,6 +6354,7 @@ async def admin_unban_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await update.message.reply_text(f"❌ Foydalanuvchi `{user_id}` topilmadi.", parse_mode="Markdown")
                 return
             await conn.execute("UPDATE users SET is_banned = FALSE WHERE id = $1", user_id)
+            await invalidate_user(conn, user_id)
         await update.message.reply_text(f"✅ Foydalanuvchi `{user_id}` muvaffaqiyatli **bandan chiqarildi**.", parse_mode="Markdown")
     except ValueError:
         await update.message.reply_text("❌ Noto'g'ri ID. Faqat raqam yuboring.")
@@ -3542,6 +6412,7 @@ async def admin_ban_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(f"❌ Foydalanuvchi `{user_id}` topilmadi.", parse_mode="Markdown")
                 return ConversationHandler.END
             await conn.execute("UPDATE users SET is_banned = TRUE WHERE id = $1", user_id)
+            await invalidate_user(conn, user_id)
         await update.message.reply_text(f"✅ Foydalanuvchi `{user_id}` **ban qilindi**.", parse_mode="Markdown")
     except ValueError:
         await update.message.reply_text("❌ Noto'g'ri ID. Faqat raqam yuboring.")
@@ -3551,8 +6422,8 @@ async def admin_show_user_card(context: ContextTypes.DEFAULT_TYPE, user_id: int,
     pool = context.application.bot_data["db_pool"]
     async with pool.acquire() as conn:
         u = await conn.fetchrow(
-            "SELECT id, username, language_code, is_banned, image_model_id, extra_credits, last_seen, first_seen "
-            "FROM users WHERE id=$1",
+            "SELECT id, username, language_code, is_banned, image_model_id, extra_credits, total_images, "
+            "last_seen, first_seen FROM users WHERE id=$1",
             user_id
         )
         if not u:
@@ -3562,12 +6433,10 @@ async def admin_show_user_card(context: ContextTypes.DEFAULT_TYPE, user_id: int,
                 await message.reply_text("❌ Foydalanuvchi topilmadi.")
             return
 
-        total_images = int(await conn.fetchval(
-            "SELECT COALESCE(SUM(image_count),0) FROM generations WHERE user_id=$1", user_id
-        ) or 0)
+        total_images = int(u["total_images"] or 0)
         today_images = int(await conn.fetchval(
-            "SELECT COALESCE(SUM(image_count),0) FROM generations WHERE user_id=$1 AND created_at >= $2",
-            user_id, tashkent_day_start_utc()
+            "SELECT images FROM user_daily_usage WHERE user_id=$1 AND tashkent_day=$2",
+            user_id, tashkent_today()
         ) or 0)
 
     lang = get_lang(u["language_code"] or DEFAULT_LANGUAGE)
@@ -3616,7 +6485,7 @@ async def admin_user_stats_handler(update: Update, context: ContextTypes.DEFAULT
     pool = context.application.bot_data["db_pool"]
     async with pool.acquire() as conn:
         total_images = int(await conn.fetchval(
-            "SELECT COALESCE(SUM(image_count),0) FROM generations WHERE user_id=$1", user_id
+            "SELECT COALESCE(total_images, 0) FROM users WHERE id=$1", user_id
         ) or 0)
         last10 = await conn.fetch(
             "SELECT prompt, image_count, created_at FROM generations WHERE user_id=$1 ORDER BY created_at DESC LIMIT 10",
@@ -3739,7 +6608,8 @@ async def admin_export_db_handler(update: Update, context: ContextTypes.DEFAULT_
         users = await conn.fetch("SELECT * FROM users ORDER BY last_seen DESC")
         gens = await conn.fetch("SELECT * FROM generations ORDER BY created_at DESC LIMIT 20000")
         dons = await conn.fetch("SELECT * FROM donations ORDER BY created_at DESC LIMIT 20000")
-        sess = await conn.fetch("SELECT * FROM sessions ORDER BY started_at DESC LIMIT 20000")
+        today = tashkent_today()
+        activity = await activity_day_counts(conn, today - timedelta(days=365), today)
 
     def dump_csv(rows, filename):
         if not rows:
@@ -3755,7 +6625,10 @@ async def admin_export_db_handler(update: Update, context: ContextTypes.DEFAULT_
     dump_csv(users, "users.csv")
     dump_csv(gens, "generations.csv")
     dump_csv(dons, "donations.csv")
-    dump_csv(sess, "sessions.csv")
+    dump_csv(
+        [{"tashkent_day": day.isoformat(), "active_users": count} for day, count in sorted(activity.items(), reverse=True)],
+        "daily_activity.csv"
+    )
 
     zpath = tmpdir / "export.zip"
     with zipfile.ZipFile(zpath, "w", compression=zipfile.ZIP_DEFLATED) as z:
@@ -3771,8 +6644,9 @@ async def admin_manage_tokens_handler(update: Update, context: ContextTypes.DEFA
     q = update.callback_query
     await q.answer()
     total = len(DIGEN_KEYS) if isinstance(DIGEN_KEYS, list) else 0
+    key_lines = "\n".join(context.application.bot_data["digen_keys"].stats_lines())
     await q.edit_message_text(
-        f"🔑 *Digen tokenlar*\n\nJami tokenlar: `{total}`\n\nTokenlarni o'zgartirish uchun serverdagi `.env` (DIGEN_KEYS) ni yangilang.",
+        f"🔑 *Digen tokenlar*\n\nJami tokenlar: `{total}`\n\n{key_lines}\n\nTokenlarni o'zgartirish uchun serverdagi `.env` (DIGEN_KEYS) ni yangilang.",
         parse_mode="Markdown",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Orqaga", callback_data="admin_settings")]])
     )
@@ -3811,10 +6685,71 @@ async def on_startup(app: Application):
     app.bot_data["db_pool"] = pool
     await init_db(pool)
     logger.info("✅ DB initialized and pool created.")
+    # Katta jadvallarda indeks qurilishi uzoq davom etadi — bot ishga tushishini kutdirmaymiz
+    app.bot_data["index_task"] = asyncio.create_task(ensure_indexes(DATABASE_URL))
+
+    WRITE_BEHIND.start(pool)
+    app.bot_data["retention_task"] = asyncio.create_task(sessions_retention_loop(pool))
+
+    cache_listener = CacheInvalidationListener(DATABASE_URL, CACHE_NOTIFY_CHANNEL)
+    cache_listener.start()
+    app.bot_data["cache_listener"] = cache_listener
+
+    app.bot_data["http"] = create_http_sessions()
+    app.bot_data["digen_keys"] = DigenKeyPool(DIGEN_KEYS, DIGEN_KEY_MAX_CONCURRENCY)
+    app.bot_data["digen_breaker"] = CircuitBreaker(
+        "digen",
+        window=DIGEN_BREAKER_WINDOW,
+        min_calls=DIGEN_BREAKER_MIN_CALLS,
+        failure_rate=DIGEN_BREAKER_FAILURE_RATE,
+        open_seconds=DIGEN_BREAKER_OPEN_SECONDS,
+        probes=DIGEN_BREAKER_PROBES,
+        on_change=_digen_breaker_notifier(app),
+    )
+
+    ready_poller = ReadinessPoller(app, READY_POLL_CONCURRENCY)
+    ready_poller.start()
+    app.bot_data["ready_poller"] = ready_poller
+
+    gen_queue = GenerationQueue(app, GEN_WORKERS, GEN_QUEUE_MAX)
+    gen_queue.start()
+    app.bot_data["gen_queue"] = gen_queue
+
+async def on_shutdown(app: Application):
+    gen_queue = app.bot_data.get("gen_queue")
+    if gen_queue:
+        await gen_queue.stop()
+    ready_poller = app.bot_data.get("ready_poller")
+    if ready_poller:
+        await ready_poller.stop()
+    # Bot bu paytda yopilgan — breaker xabarlari yuborilmaydi, faqat bekor qilinadi
+    notify_tasks = list(app.bot_data.get("notify_tasks", ()))
+    for task in notify_tasks:
+        task.cancel()
+    await asyncio.gather(*notify_tasks, return_exceptions=True)
+    cache_listener = app.bot_data.get("cache_listener")
+    if cache_listener:
+        await cache_listener.stop()
+    for name in ("index_task", "retention_task"):
+        task = app.bot_data.get(name)
+        if task and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    await AI_CHAT_INFLIGHT.stop()
+    await AI_CHAT_MEMORY.stop()
+    await GEMINI_BATCHER.stop()
+    # Buferda qolgan yozuvlar pool yopilishidan oldin yoziladi
+    await WRITE_BEHIND.stop()
+    sessions = app.bot_data.get("http")
+    if sessions:
+        await close_http_sessions(sessions)
+    pool = app.bot_data.get("db_pool")
+    if pool:
+        await pool.close()
 
 # ---------------- MAIN ----------------
 def build_app():
-    app = Application.builder().token(BOT_TOKEN).post_init(on_startup).build()
+    app = Application.builder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
     all_lang_pattern = r"lang_(uz|ru|en|id|lt|esmx|eses|it|zhcn|bn|hi|ptbr|ar|uk|vi)"
     
     # --- Handlers ---
@@ -3908,6 +6843,12 @@ def build_app():
     app.add_handler(CallbackQueryHandler(handle_start_gen, pattern="^start_gen$"))
     app.add_handler(CallbackQueryHandler(start_ai_flow_handler, pattern="^start_ai_flow$"))
     app.add_handler(CallbackQueryHandler(check_sub_button_handler, pattern="^check_sub$"))
+    # Bot kanalda admin bo'lsa, a'zolik o'zgarishlari keladi
+    app.add_handler(ChatMemberHandler(
+        chat_member_update_handler,
+        ChatMemberHandler.CHAT_MEMBER,
+        chat_id=[ch["id"] for ch in MANDATORY_CHANNELS]
+    ))
     app.add_handler(CallbackQueryHandler(generate_cb, pattern=r"^count_\d+$"))
     app.add_handler(CallbackQueryHandler(buy_pack_handler, pattern=r"^buy_pack_\d+$"))
     app.add_handler(CallbackQueryHandler(gen_image_from_prompt_handler, pattern="^gen_image_from_prompt$"))
@@ -3924,7 +6865,15 @@ def build_app():
 def main():
     app = build_app()
     logger.info("Application initialized. Starting polling...")
-    app.run_polling()
+    # chat_member yangilanishlari standart holatda kelmaydi — aniq so'raladi
+    # Faqat handlerlar ishlatadigan turlar; chat_member standart holatda kelmaydi — aniq so'raladi.
+    # edited_message so'ralmaydi: matn handlerlari update.message bilan ishlaydi.
+    app.run_polling(allowed_updates=[
+        Update.MESSAGE,
+        Update.CALLBACK_QUERY,
+        Update.PRE_CHECKOUT_QUERY,
+        Update.CHAT_MEMBER,
+    ])
 
 
 if __name__ == "__main__":